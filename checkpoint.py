@@ -0,0 +1,129 @@
+import os
+import json
+import shutil
+import hashlib
+import threading
+from pathlib import Path
+
+import numpy as np
+
+RUN_DIR = Path("output_csv")
+MANIFEST_FILE = "manifest.jsonl"
+# manifests of this process, created by several threads of the pipeline
+_MANIFESTS = {}
+_MANIFESTS_LOCK = threading.Lock()
+# a forked worker process must not inherit the lock held by another thread of its parent
+os.register_at_fork(after_in_child=lambda: globals().update(_MANIFESTS_LOCK=threading.Lock()))
+
+
+def checksum(files: list) -> str:
+    """Return the sha256 checksum of the content of one or more files."""
+    digest = hashlib.sha256()
+    for file in files:
+        with open(file, "rb") as f:
+            while block := f.read(1024 ** 2):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+class RunManifest:
+    """
+    Records every finished column, id pool, merged table and loaded table of a run in an append-only manifest,
+    so that an interrupted run can be resumed without repeating finished work.
+
+    Every entry stores the parameters of the run, and it is only valid if they equal the parameters of the
+    resumed run and the checksum of its files still matches.
+    """
+
+    def __init__(self, year: int, k: int, run_dir: Path = RUN_DIR, sample_fraction: float | None = None):
+        # every year has its own manifest and id pools
+        self.run_dir = run_dir / str(year)
+        self.parameters = {"year": year, "k": k, "sample_fraction": sample_fraction}
+        self.manifest_file = self.run_dir / MANIFEST_FILE
+        self.entries = {}
+        if self.manifest_file.exists():
+            with self.manifest_file.open("r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # a line cut off by a crash
+                    self.entries[(entry["kind"], entry["table"], entry["column"])] = entry
+
+    def clear(self):
+        """Forget all entries of earlier runs and remove their id pools."""
+        self.entries = {}
+        self.manifest_file.unlink(missing_ok=True)
+        shutil.rmtree(self.run_dir / "pools", ignore_errors=True)
+
+    def record(self, kind: str, table: str, column: str | None = None, rows: int | None = None,
+               files: list | None = None):
+        """
+        Appends an entry to the manifest. Each entry is written with a single write, so that entries of
+        several processes are not interleaved.
+
+        Parameters:
+            kind (str): The kind of the entry, i.e. column, pool, sample, table or loaded
+            table (str): The name of the table (Satzart), or of the pool or sample
+            column (str | None): The name of the column
+            rows (int | None): The number of rows
+            files (list | None): The files written, their checksum is recorded
+        """
+        entry = {"kind": kind, "table": table, "column": column, "rows": rows, **self.parameters}
+        if files is not None:
+            entry["files"] = [str(file) for file in files]
+            entry["checksum"] = checksum(files)
+        self.run_dir.mkdir(parents=True, exist_ok=True)
+        with self.manifest_file.open("a") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.entries[(kind, table, column)] = entry
+
+    def finished(self, kind: str, table: str, column: str | None = None, rows: int | None = None) -> list | None:
+        """
+        Returns the files of a finished entry, if it was recorded with the same parameters and row count
+        and its files are unchanged.
+
+        Parameters:
+            kind (str): The kind of the entry, i.e. column, pool, sample, table or loaded
+            table (str): The name of the table (Satzart), or of the pool or sample
+            column (str | None): The name of the column
+            rows (int | None): The expected number of rows, not checked if None
+
+        Returns:
+            files (list | None): The recorded files, an empty list for entries without files, or None
+        """
+        entry = self.entries.get((kind, table, column))
+        if entry is None or any(entry.get(key) != value for key, value in self.parameters.items()):
+            return None
+        if rows is not None and entry["rows"] != rows:
+            return None
+        files = [Path(file) for file in entry.get("files", [])]
+        if files and (not all(file.exists() for file in files) or checksum(files) != entry["checksum"]):
+            return None
+        return files
+
+    def save_pool(self, key: str, pool: np.ndarray):
+        """Persist an id pool, so that a resumed run uses the same pseudonyms."""
+        pool_file = self.run_dir / "pools" / f"{key}.npy"
+        pool_file.parent.mkdir(parents=True, exist_ok=True)
+        np.save(pool_file, pool)
+        self.record("pool", key, rows=len(pool), files=[pool_file])
+
+    def load_pool(self, key: str) -> np.ndarray | None:
+        """Return a persisted id pool, or None if there is no valid one."""
+        files = self.finished("pool", key)
+        return np.load(files[0]) if files else None
+
+
+def get_manifest(year: int, k: int, run_dir: Path = RUN_DIR, sample_fraction: float | None = None) -> RunManifest:
+    """
+    Returns the manifest of the current process, which is read on first use.
+    Worker processes read the manifest as left by the main process at the start of the run.
+    """
+    key = (os.getpid(), year, k, str(run_dir), sample_fraction)
+    with _MANIFESTS_LOCK:
+        if key not in _MANIFESTS:
+            _MANIFESTS[key] = RunManifest(year, k, run_dir, sample_fraction)
+        return _MANIFESTS[key]
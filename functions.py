@@ -1,48 +1,184 @@
 import string
 import secrets
 import sys
+import pickle
+from itertools import chain
+from pathlib import Path
 
 import pandas as pd
 import numpy as np
-import random
-
-from helpers import get_constant_variables, get_pseudo_variables
+from collections import defaultdict
 
 POSSIBLE_CHARACTERS = string.ascii_uppercase + string.ascii_lowercase + string.digits
-UNCHANGED_VARIABLES = get_pseudo_variables() + get_constant_variables()
+NUMERIC_TYPES = ['date', 'year', 'integer', 'float', 'month']
+OTHER_CATEGORY = 'Other'
+
+
+def random_bytes(size: int, stream=None) -> bytes:
+    """Draw random bytes from a keyed stream of the run (see randomness.py), or by default using
+    secrets.token_bytes from the most secure source of randomness that your operating system provides.
+
+    Parameters:
+        size: Number of bytes.
+        stream: The keyed stream to draw from, or None.
+    Returns:
+        bytes: The random bytes.
+    """
+    return secrets.token_bytes(size) if stream is None else stream.token_bytes(size)
+
 
+def generate_secure_integers(size: int, stream=None) -> np.ndarray:
+    """Generate secure random 64-bit integers, drawing the bytes for the whole array at once.
 
-def generate_secure_bytes(size: int, n_bytes=32):
-    """Generate secure byte strings using secrets.token_hex.
-    This uses the most secure source of randomness that your operating system provides.
+    Parameters:
+        size: Length of array to be returned.
+        stream: The keyed stream to draw from, or None for the secure source of randomness.
+    Returns:
+        numpy.ndarray: Array of secure random unsigned 64-bit integers.
+    """
+    return np.frombuffer(random_bytes(8 * size, stream), dtype=np.uint64)
+
+
+def generate_secure_integers_below(size: int, bound: int, stream=None) -> np.ndarray:
+    """Generate secure random integers that are uniformly distributed between 0 and bound - 1.
+
+    Integers from the part of the 64-bit range that is not a multiple of bound are drawn again
+    (rejection sampling), so the modulo does not favour small values.
 
     Parameters:
         size: Length of array to be returned.
-        n_bytes: Number of bytes to generate a random byte string.
+        bound: Exclusive upper bound of the integers.
+        stream: The keyed stream to draw from, or None for the secure source of randomness.
+    Returns:
+        numpy.ndarray: Array of secure random integers.
+    """
+    if size == 0:
+        return np.empty(0, dtype=np.int64)
+    threshold = np.uint64(2 ** 64 % bound)
+    integers = generate_secure_integers(size, stream).copy()
+    rejected = np.flatnonzero(integers < threshold)
+    while len(rejected):
+        integers[rejected] = generate_secure_integers(len(rejected), stream)
+        rejected = rejected[integers[rejected] < threshold]
+    return (integers % np.uint64(bound)).astype(np.int64)
+
+
+def secure_permutation(size: int, stream=None) -> np.ndarray:
+    """Draw a uniformly random permutation from the secure source of randomness.
+
+    The permutation is the order of random 64-bit keys. If any two keys collide, all keys are
+    drawn again (rejection sampling), so every permutation is equally likely.
+
+    Parameters:
+        size: Length of the permutation.
+        stream: The keyed stream to draw from, or None for the secure source of randomness.
+    Returns:
+        numpy.ndarray: A permutation of the indices 0, ..., size - 1.
+    """
+    while True:
+        keys = generate_secure_integers(size, stream)
+        order = np.argsort(keys)
+        sorted_keys = keys[order]
+        if not (sorted_keys[1:] == sorted_keys[:-1]).any():
+            return order
+
+
+def draw_sample(size: int, fraction: float, stream=None) -> np.ndarray:
+    """Draw a simple random sample without replacement of a fraction of the indices 0, ..., size - 1
+    from the secure source of randomness.
+
+    Parameters:
+        size: Number of elements of the population.
+        fraction: Share of the population to sample, the sample size is rounded.
+        stream: The keyed stream to draw from, or None for the secure source of randomness.
     Returns:
-        numpy.ndarray: Array of secure random bytes.
+        numpy.ndarray: The sampled indices in ascending order.
     """
-    return np.array([secrets.token_hex(n_bytes) for _ in range(size)])
+    return np.sort(secure_permutation(size, stream)[:round(fraction * size)])
 
 
-def shuffle_column(variable: pd.Series):
+def shuffle_column(variable: pd.Series, stream=None):
     """Shuffle values based on random bytes.
 
     Parameters:
         variable (array-like): Input vector of any length.
+        stream: The keyed stream to draw from, or None for the secure source of randomness.
 
     Returns:
-        pandas.Series: The same vector, randomly ordered.
+        pandas.Series: The same vector with the same dtype, randomly ordered.
     """
-    # Generate random integers for sorting
-    random_integers = generate_secure_bytes(len(variable))
+    variable = pd.Series(variable)
+    return variable.take(secure_permutation(len(variable), stream)).reset_index(drop=True)
 
-    # Sort variable using the random bytes
-    # Returns the indices that would sort an array.
-    sorted_indices = np.argsort(random_integers)
-    shuffled_variable = np.array(variable)[sorted_indices]
 
-    return pd.Series(shuffled_variable)
+def external_shuffle(chunks, n_rows: int, bucket_dir: Path, memory_limit: int, stream=None):
+    """Shuffle a column that does not fit into memory, using buckets on disk.
+
+    Every value is written into one of several bucket files, chosen uniformly at random from the secure source
+    of randomness. Each bucket is small enough to be shuffled in memory afterwards, and the buckets are
+    returned in random order. As the bucket of each value and the order within each bucket are uniformly
+    random, the whole column is a uniformly random permutation. The frequencies of the values are
+    counted in the same pass, so k-anonymity can be applied to the shuffled buckets.
+
+    Categorical buckets are returned with the categories of the whole column, so that they stay categorical
+    when their parts from different chunks are concatenated. Their size is estimated from the codes of their
+    rows and the categories every bucket holds.
+
+    Parameters:
+        chunks (iterable): The column in pieces of pandas.Series
+        n_rows (int): Length of the whole column
+        bucket_dir (Path): Directory for the bucket files
+        memory_limit (int): Maximum size of a bucket in memory in bytes
+        stream: The keyed stream to draw from, or None for the secure source of randomness
+
+    Returns:
+        tuple: The frequencies of the whole column (pandas.Series) and a generator of the shuffled buckets
+    """
+    chunks = iter(chunks)
+    first_chunk = next(chunks, pd.Series([], dtype=object))
+    categorical = isinstance(first_chunk.dtype, pd.CategoricalDtype)
+    if categorical:
+        # at most 4 bytes per code, the categories are assumed to at most double after the first chunk
+        bytes_per_row = 4
+        memory_limit = max(memory_limit - 2 * first_chunk.cat.categories.memory_usage(deep=True), memory_limit // 2)
+        categories = first_chunk.cat.categories
+    else:
+        bytes_per_row = first_chunk.memory_usage(deep=True, index=False) / max(len(first_chunk), 1)
+    n_buckets = max(1, int(np.ceil(n_rows * bytes_per_row / memory_limit)))
+    bucket_files = [bucket_dir / f"bucket_{bucket}.pkl" for bucket in range(n_buckets)]
+
+    chunk_counts = []
+    for chunk in chain([first_chunk], chunks):
+        chunk = chunk.reset_index(drop=True)
+        if categorical:
+            categories = categories.union(chunk.cat.categories)
+        chunk_counts.append(chunk.value_counts(dropna=False))
+        buckets = generate_secure_integers_below(len(chunk), n_buckets, stream)
+        order = np.argsort(buckets, kind='stable')
+        bounds = np.cumsum(np.bincount(buckets, minlength=n_buckets))
+        for bucket, (start, stop) in enumerate(zip(np.concatenate([[0], bounds[:-1]]), bounds)):
+            if stop > start:
+                with bucket_files[bucket].open("ab") as f:
+                    pickle.dump(chunk.take(order[start:stop]), f, protocol=pickle.HIGHEST_PROTOCOL)
+    counts = pd.concat(chunk_counts).groupby(level=0, dropna=False, observed=True).sum()
+
+    def shuffled_buckets():
+        for bucket in secure_permutation(n_buckets, stream):
+            if not bucket_files[bucket].exists():
+                continue
+            parts = []
+            with bucket_files[bucket].open("rb") as f:
+                while True:
+                    try:
+                        parts.append(pickle.load(f))
+                    except EOFError:
+                        break
+            bucket_files[bucket].unlink()
+            if categorical:
+                parts = [part.cat.set_categories(categories) for part in parts]
+            yield shuffle_column(pd.concat(parts, ignore_index=True), stream)
+
+    return counts, shuffled_buckets()
 
 
 def assert_k_condition(k: int):
@@ -58,72 +194,331 @@ def check_k_single_variable(vector: pd.Series, k: int):
     return k_check
 
 
-def force_k(values: pd.Series, value_type: str, k: int):
-    """Shuffle values based on random integers.
+def force_k(values: pd.Series, value_type: str, k: int, counts: pd.Series = None):
+    """Generalize values until every value occurs at least k times.
 
     Parameters:
         values (array-like): Input vector of any length
         value_type (str): The type of data, as defined in `data_types.csv`
         k (int): Parameter to fulfill k-anonymity
+        counts (pandas.Series): Frequencies of the whole column, missing values included, if `values`
+            is only a part of it. By default, the frequencies of `values` are used.
 
     Returns:
         pandas.Series: A vector fulfilling k-anonymity
     """
-    # convert series into dataframe for better processing
-    df = pd.DataFrame({'values': list(values)})
-    if value_type in ['date', 'year', 'integer', 'float', 'month']:
-        while True:
-            number_counts = df['values'].value_counts(dropna=False)
-            numbers_to_change = number_counts[number_counts < k].index
-            if numbers_to_change.empty:
-                break
-            numbers_subset = df[df['values'].isin(numbers_to_change)]
-            cur_number = numbers_subset['values'].iloc[0]
-            nearest_number = find_nearest_number(df['values'].dropna(), cur_number)
-            check_nan = True if pd.isnull(cur_number) else False
-            if check_nan:
-                df.fillna(nearest_number, inplace=True)
-            else:
-                df.loc[df['values'] == cur_number] = nearest_number
-        return pd.Series(df['values'].to_list())
+    if value_type in NUMERIC_TYPES:
+        values = pd.Series(values).reset_index(drop=True)
+        if counts is None:
+            counts = values.value_counts(dropna=False)
+        mapping = k_anonymity_mapping(counts, value_type, k)
+        return apply_mapping(values, mapping)
+    elif value_type in ('category', 'alphanumeric', 'string'):
+        # the generalization is applied to the categories, the rows only keep their codes
+        values = pd.Series(values).reset_index(drop=True).astype('category')
+        if counts is None:
+            codes = values.cat.codes.to_numpy()
+            counts = pd.Series(np.bincount(codes[codes >= 0], minlength=len(values.cat.categories)),
+                               index=values.cat.categories)
+            n_missing = np.count_nonzero(codes < 0)
+            if n_missing:
+                missing_counts = pd.Series([n_missing], index=[np.nan])
+                # an all-missing column has no categories, empty entries are not concatenated
+                counts = pd.concat([counts, missing_counts]) if len(counts) else missing_counts
+        mapping = k_anonymity_mapping(counts, value_type, k)
+        return remap_categories(values, mapping)
+    else:
+        sys.exit(f"Data type {value_type} is not supported.")
+
+
+def force_k_from_histogram(values: pd.Series, counts: np.ndarray, value_type: str, k: int,
+                           stream=None) -> pd.Series:
+    """Build a randomly ordered, k-anonymous column from the histogram of a column alone.
+
+    As shuffling and k-anonymity only depend on the frequencies of the values, the generalization is planned
+    on the distinct values and every generalized value is repeated as often as its original value occurred,
+    in the order of a secure random permutation. The result has the same distribution as shuffling the whole
+    column and applying `force_k`.
+
+    Parameters:
+        values (pandas.Series): The cleaned distinct values of the column, as returned by `clean_data`
+        counts (numpy.ndarray): The frequency of every value
+        value_type (str): The type of data, as defined in `data_types.csv`
+        k (int): Parameter to fulfill k-anonymity
+        stream: The keyed stream to draw from, or None for the secure source of randomness
+
+    Returns:
+        pandas.Series: The shuffled, k-anonymous column with sum(counts) values
+    """
+    values = pd.Series(values).reset_index(drop=True)
+    counts = np.asarray(counts, dtype=np.int64)
+    # distinct original values may be cleaned to the same value, e.g. all invalid dates are missing
+    histogram = pd.Series(counts, index=values).groupby(level=0, dropna=False, observed=True).sum()
+    generalized = force_k(values, value_type, k=k, counts=histogram)
+    rows = np.repeat(np.arange(len(values)), counts)
+    return generalized.take(rows[secure_permutation(len(rows), stream)]).reset_index(drop=True)
+
+
+def k_anonymity_mapping(counts: pd.Series, value_type: str, k: int) -> pd.Series:
+    """Plan the generalization of a column from its histogram alone.
+
+    Parameters:
+        counts (pandas.Series): Frequencies indexed by the distinct values of the column,
+            missing values included (e.g. `value_counts(dropna=False)`)
+        value_type (str): The type of data, as defined in `data_types.csv`
+        k (int): Parameter to fulfill k-anonymity
+
+    Returns:
+        pandas.Series: The replacement value for every distinct value, indexed like `counts`
+    """
+    assert_k_condition(k)
+    if value_type in NUMERIC_TYPES:
+        return local_rounding(counts, k)
     elif value_type == 'string':
-        while not check_k_single_variable(values, k):
-            values = [value[:-1] for value in values]
-        return pd.Series(values)
+        return hierarchical_coarsening(counts, k)
     elif value_type == 'category' or value_type == 'alphanumeric':
-        k_not_fulfilled = df['values'].value_counts(dropna=False).loc[lambda x: x < k]
-        if not k_not_fulfilled.empty:
-            if len(k_not_fulfilled) == 1 or k > sum(k_not_fulfilled):
-                # if we do have only one category that does not fulfill k,
-                # or several categories where their sum does not fulfill k either,
-                # we merge these values with the smallest valid category
-                # and call it 'Other'
-                k_fulfilled = df['values'].value_counts(dropna=False).loc[lambda x: x >= k]
-                smallest_valid_category = k_fulfilled.index.tolist()[-1]
-                df['Other'] = df['values'].apply(lambda x: x if x in k_fulfilled
-                                                 and x is not smallest_valid_category else 'Other')
-            else:
-                # otherwise, we merge all invalid categories (at least 2) together
-                df['Other'] = df['values'].apply(lambda x: x if x not in k_not_fulfilled else 'Other')
-            return pd.Series(df['Other'].to_list())
-        else:
-            return pd.Series(df['values'].to_list())
+        return other_merging(counts, k)
     else:
         sys.exit(f"Data type {value_type} is not supported.")
 
 
-def find_nearest_number(values: pd.Series, single_value):
-    values = [val for val in values if val != single_value]
-    if not values:
-        return None
-    elif single_value is None:
-        return min(values)
-    else:
-        return min(values, key=lambda x: abs(x - single_value))
+def local_rounding(counts: pd.Series, k: int) -> pd.Series:
+    """Round every value occurring less than k times to the nearest value that occurs at least k times.
 
+    The histogram is sorted once and every rare value looks up its nearest k-fulfilling neighbour
+    with a binary search. Ties are rounded down. If no value fulfills k on its own, neighbouring
+    values are merged from the smallest upwards until each group fulfills k. Missing values that
+    do not fulfill k are set to the smallest value, as non-missing values that cannot fulfill k
+    together are set to missing. If neither fulfills k, all values are set to missing as one group.
 
-def generate_pseudonym(variable: string, length=19):
-    if variable in ['ARBNR', 'VSID', 'PSID', 'VERANLASSSTELLEPSEUDO']:
-        return ''.join(random.choices(POSSIBLE_CHARACTERS, k=length))
+    Parameters:
+        counts (pandas.Series): Frequencies indexed by the distinct values, missing values included
+        k (int): Parameter to fulfill k-anonymity
+
+    Returns:
+        pandas.Series: The rounded value for every distinct value, indexed like `counts`
+    """
+    missing = np.asarray(counts.index.isna())
+    n_missing = counts[missing].sum()
+    histogram = counts[~missing].sort_index()
+    uniques = histogram.index
+    frequencies = histogram.to_numpy()
+    targets = np.arange(len(uniques))
+
+    valid = frequencies >= k
+    if valid.any():
+        valid_positions = np.flatnonzero(valid)
+        rare_positions = np.flatnonzero(~valid)
+        axis = _numeric_axis(uniques)
+        right = np.searchsorted(valid_positions, rare_positions)
+        left = right - 1
+        lower = valid_positions[np.maximum(left, 0)]
+        upper = valid_positions[np.minimum(right, len(valid_positions) - 1)]
+        distance_lower = axis[rare_positions] - axis[lower]
+        distance_upper = axis[upper] - axis[rare_positions]
+        round_down = (right == len(valid_positions)) | ((left >= 0) & (distance_lower <= distance_upper))
+        targets[rare_positions] = np.where(round_down, lower, upper)
+    elif frequencies.sum() >= k:
+        # no single value fulfills k: merge neighbours into groups, each represented by its most frequent value
+        group_start, group_size = 0, 0
+        for position, frequency in enumerate(frequencies):
+            group_size += frequency
+            if group_size >= k:
+                group = slice(group_start, position + 1)
+                targets[group] = group_start + np.argmax(frequencies[group])
+                group_start, group_size = position + 1, 0
+        # the remainder of the largest values is rounded to the last group
+        targets[group_start:] = targets[group_start - 1]
+    elif len(frequencies) > 0:
+        targets[:] = np.argmax(frequencies)
+
+    rounded = pd.Series(uniques.take(targets), index=uniques)
+    if n_missing > 0 and 0 < frequencies.sum() < k:
+        # values that cannot fulfill k among themselves are suppressed, together with the missing values
+        rounded[:] = None
+    rounded = rounded.reindex(counts.index)
+    if 0 < n_missing < k and frequencies.sum() >= k:
+        rounded[missing] = uniques[targets.min()]
+    return rounded
+
+
+def hierarchical_coarsening(counts: pd.Series, k: int) -> pd.Series:
+    """Truncate codes (e.g. ICD, OPS) occurring less than k times to the next hierarchy level.
+
+    The codes are kept as a prefix tree with the number of occurrences per node. Starting with the
+    longest codes, every node that does not fulfill k is merged into its parent, i.e. the code without
+    its last character, so only the failing branches are coarsened. If the root (the empty code)
+    still does not fulfill k, the least frequent remaining codes are merged into the root as well.
+
+    Parameters:
+        counts (pandas.Series): Frequencies indexed by the distinct codes, missing values included
+        k (int): Parameter to fulfill k-anonymity
+
+    Returns:
+        pandas.Series: The coarsened code for every distinct code, indexed like `counts`
+    """
+    missing = np.asarray(counts.index.isna())
+    # codes read from the database may be numbers, e.g. PLZ or PZN, they are truncated as text
+    codes = counts.index[~missing]
+    if pd.api.types.is_float_dtype(codes.dtype) and np.all(np.mod(codes, 1) == 0):
+        # integers are read as floats if the column has missing values
+        codes = codes.astype(np.int64)
+    codes = codes.astype(str)
+    nodes = dict(zip(codes, counts[~missing]))
+    levels = defaultdict(list)
+    for code in nodes:
+        levels[len(code)].append(code)
+
+    parents = {}
+    for length in range(max(levels, default=0), 0, -1):
+        for code in levels[length]:
+            if nodes[code] < k:
+                parent = code[:-1]
+                if parent not in nodes:
+                    nodes[parent] = 0
+                    levels[length - 1].append(parent)
+                nodes[parent] += nodes.pop(code)
+                parents[code] = parent
+
+    if 0 < nodes.get('', 0) < k:
+        for code in sorted(nodes, key=nodes.get):
+            if nodes[''] >= k:
+                break
+            if code != '':
+                nodes[''] += nodes.pop(code)
+                parents[code] = ''
+
+    def resolve(code):
+        while code in parents:
+            code = parents[code]
+        return code
+
+    coarsened = [resolve(code) for code in codes]
+    return pd.Series(coarsened, index=counts.index[~missing], dtype=object).reindex(counts.index)
+
+
+def other_merging(counts: pd.Series, k: int) -> pd.Series:
+    """Merge categories occurring less than k times into the category 'Other'.
+
+    If only one category does not fulfill k, or several categories whose sum does not fulfill k either,
+    the smallest category fulfilling k is merged into 'Other' as well. Missing values are treated as a category.
+
+    Parameters:
+        counts (pandas.Series): Frequencies indexed by the categories, missing values included
+        k (int): Parameter to fulfill k-anonymity
+
+    Returns:
+        pandas.Series: The merged category for every category, indexed like `counts`
+    """
+    present = counts[counts > 0].sort_values(ascending=False, kind='stable')
+    rare = (present < k).to_numpy()
+    if rare.any() and (rare.sum() == 1 or k > present[rare].sum()):
+        valid_positions = np.flatnonzero(~rare)
+        if len(valid_positions):
+            rare[valid_positions[-1]] = True
+    merged = pd.Series(present.index, index=present.index, dtype=object)
+    merged.iloc[np.flatnonzero(rare)] = OTHER_CATEGORY
+    return merged.reindex(counts.index)
+
+
+def remap_categories(values: pd.Series, mapping: pd.Series) -> pd.Series:
+    """Apply a mapping of categories to a categorical column by remapping its codes.
+
+    Parameters:
+        values (pandas.Series): Categorical input vector of any length
+        mapping (pandas.Series): New category for every category of `values`, missing values included
+
+    Returns:
+        pandas.Series: Categorical vector with the new categories
+    """
+    missing = np.asarray(mapping.index.isna())
+    targets = mapping[~missing].reindex(values.cat.categories)
+    missing_target = pd.Series([mapping[missing].iloc[0] if missing.any() else np.nan])
+    # the last entry of the lookup is used for missing values, which have the code -1
+    entries = pd.concat([targets, missing_target]) if len(targets) else missing_target
+    new_categories = pd.Index(pd.unique(entries.dropna()))
+    lookup = new_categories.get_indexer(entries)
+    new_codes = lookup[values.cat.codes.to_numpy()]
+    return pd.Series(pd.Categorical.from_codes(new_codes, categories=new_categories))
+
+
+def _numeric_axis(uniques: pd.Index) -> np.ndarray:
+    """Return the distinct values of a numeric, year, month or date column as floats to measure distances."""
+    try:
+        return uniques.to_numpy(dtype=float)
+    except (TypeError, ValueError):
+        return pd.to_datetime(uniques).asi8.astype(float)
+
+
+def apply_mapping(values: pd.Series, mapping: pd.Series) -> pd.Series:
+    """Replace every value by its entry in a mapping of distinct values with one vectorized lookup.
+
+    Parameters:
+        values (pandas.Series): Input vector of any length
+        mapping (pandas.Series): Replacement values, indexed by the distinct values of `values`
+
+    Returns:
+        pandas.Series: The replaced values, missing values are kept unless the mapping replaces them
+    """
+    missing = np.asarray(mapping.index.isna())
+    present = mapping[~missing]
+    if present.empty:
+        result = values.copy()
     else:
-        return ''.join(random.choices(string.digits, k=length))
+        codes = present.index.get_indexer(values)
+        result = pd.Series(present.array.take(np.maximum(codes, 0)))
+        result = result.where(codes >= 0, values)
+    if missing.any() and not pd.isnull(mapping[missing].iloc[0]):
+        result[result.isna()] = mapping[missing].iloc[0]
+    return result
+
+
+def generate_pseudonyms(size: int, variable: str = None, length=19, stream=None) -> np.ndarray:
+    """Generate a pool of unique pseudonyms from the secure source of randomness.
+
+    The random bytes for all pseudonyms are drawn at once and mapped onto the characters,
+    bytes that would favour some characters are drawn again. Duplicate pseudonyms are replaced
+    until all pseudonyms in the pool are unique.
+
+    Parameters:
+        size (int): Number of pseudonyms
+        variable (str): The pool the pseudonyms are generated for, which determines the characters used
+        length (int): Number of characters per pseudonym
+        stream: The keyed stream to draw from, or None for the secure source of randomness
+
+    Returns:
+        numpy.ndarray: Fixed-width byte strings of unique pseudonyms
+    """
+    characters = POSSIBLE_CHARACTERS if variable in ['ARBNR', 'VSID', 'PSID', 'VERANLASSSTELLEPSEUDO'] \
+        else string.digits
+    assert size <= len(characters) ** length, f"Not enough pseudonyms of length {length} for a pool of size {size}"
+    characters = np.frombuffer(characters.encode(), dtype=np.uint8)
+    limit = 256 - 256 % len(characters)
+
+    pseudonyms = np.empty((size, length), dtype=np.uint8)
+    missing = np.arange(size)
+    while len(missing):
+        drawn = np.frombuffer(random_bytes(len(missing) * length, stream), dtype=np.uint8).copy()
+        rejected = np.flatnonzero(drawn >= limit)
+        while len(rejected):
+            drawn[rejected] = np.frombuffer(random_bytes(len(rejected), stream), dtype=np.uint8)
+            rejected = rejected[drawn[rejected] >= limit]
+        pseudonyms[missing] = characters[drawn % len(characters)].reshape(len(missing), length)
+        # keep the first occurrence of every pseudonym and draw the duplicates again
+        _, first_occurrences = np.unique(pseudonyms.view(f"S{length}").ravel(), return_index=True)
+        missing = np.setdiff1d(np.arange(size), first_occurrences)
+    return pseudonyms.view(f"S{length}").ravel()
+
+
+def sample_from_pool(pool: np.ndarray, size: int, stream=None) -> np.ndarray:
+    """Draw a simple random sample with replacement from a pool of pseudonyms.
+
+    Parameters:
+        pool (numpy.ndarray): The pool of pseudonyms
+        size (int): Number of pseudonyms to draw
+        stream: The keyed stream to draw from, or None for the secure source of randomness
+
+    Returns:
+        numpy.ndarray: The drawn pseudonyms
+    """
+    return pool[generate_secure_integers_below(size, len(pool), stream)]
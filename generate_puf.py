@@ -1,25 +1,48 @@
-import random
+import os
 import sys
+import shutil
 import argparse
 from pathlib import Path
+from itertools import islice
 
 import csv
 
+import numpy as np
 import pandas as pd
-from helpers import (connect_to_database, 
+from helpers import (SQLITE_FILE_VARIABLE,
+                     DatabaseSession,
+                     get_session,
+                     close_sessions,
+                     get_data_type,
                      get_data_types, 
-                     get_pseudo_variables, 
                      get_constant_variables, 
                      clean_data,
                      get_pseudo_mapping, 
-                     get_secondary_pools_dm3)
-from functions import force_k, generate_pseudonym, shuffle_column
+                     get_secondary_pools_dm3,
+                     read_column,
+                     read_histogram,
+                     iter_column_chunks,
+                     share_pools,
+                     attach_pools)
+from functions import (force_k, force_k_from_histogram, generate_pseudonyms, shuffle_column, external_shuffle,
+                       sample_from_pool, draw_sample)
+from storage import EXPORT_FORMATS, spill_column, merge_spilled_columns, export_spilled_columns, check_export_formats
+from schema import get_schema
+from checkpoint import RUN_DIR, get_manifest
+from planner import estimate_column, load_calibration, save_calibration, calibrate, print_plan, run_admitted
+from instrumentation import span, profile_column, clear_spans, write_report
+from randomness import get_stream, load_or_generate_run_key
 import warnings
 from datetime import datetime
 from multiprocessing import Pool, cpu_count
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from typing import NamedTuple
 
 warnings.simplefilter(action='ignore', category=UserWarning)
 K = 3
+BATCH_SIZE = 50_000
+PIPELINE_DEPTH = 1  # columns fetched in advance and waiting to be spilled by each table worker
 
 
 
@@ -36,287 +59,757 @@ def get_prefix(table: str, data_model: int) -> str:
     return "BJ" if data_model == 3 else "V" if table == 'SA131' else "VBJ"
 
 
-def generate_pool_of_ids(col_name: str, table: str, data_model: int) -> list:
+def get_source_table(table: str, args: argparse.Namespace) -> str:
     """
-    Generates a pool of new ids
+    Returns the name of the table or view the original data of the specified "Satzart" is read from
+
+    Parameters:
+        table (str): The name of the current table (Satzart)
+        args (argparse.Namespace): Dictionary containing command line arguments, including year and sample fraction
+    Returns:
+        table_name (str): The original table, or the view of its rows of the sampled persons
+    """
+    table_name = f"{get_prefix(table, get_data_model_from_year(args.year))}{args.year}{table}"
+    return f"{table_name}_sample" if args.sample_fraction is not None else table_name
+
+
+def get_output_dir(year: int) -> Path:
+    """
+    Returns the directory of the csv files, spilled columns and checkpoints of a year
+
+    Parameters:
+        year (int): The year of the data
+    Returns:
+        output_dir (Path): The output directory of the year
+    """
+    return RUN_DIR / str(year)
+
+
+def generate_pool_of_ids(col_name: str, table: str, year: int, data_model: int,
+                         session: DatabaseSession, sampled: bool = False, run_key: bytes = None) -> np.ndarray:
+    """
+    Generates a pool of new ids, one for every distinct id in the original data, and at least one
 
     Parameters:
         col_name (str): The name of the column
         table (str): The name of the current table (Satzart)
+        year (int): The year of the data
         data_model: The data model of the current table
+        session (DatabaseSession): The database session of the current process
+        sampled (bool): Whether only the distinct ids of the sampled persons are counted
+        run_key (bytes): The key of the random streams of the run, None for the secure source of randomness
 
     Returns:
-        id_pool (list): A list of new randomly generated pseudonyms
+        id_pool (numpy.ndarray): Fixed-width byte strings of unique, randomly generated pseudonyms
     """
     prefix = get_prefix(table, data_model=data_model)
-    table_name = f"{prefix}{args.year}{table}"
-    cur.execute(f"SELECT {col_name} from {table_name}")
-    data = pd.Series([entry[0] for entry in cur.fetchall()])
-    id_pool = [generate_pseudonym(len(str(val))) for val in set(data)]
+    table_name = f"{prefix}{year}{table}" + ("_sample" if sampled else "")
+    with session.connect() as (cnxn, cursor):
+        cursor.execute(f"SELECT COUNT(DISTINCT {col_name}) from {table_name}")
+        n_distinct = cursor.fetchall()[0][0]
+    # missing ids are not counted, the pool has at least one id for a column without any id, e.g. in a small sample
+    id_pool = generate_pseudonyms(max(n_distinct, 1), stream=get_stream(run_key, year, table, col_name, "pool"))
 
     return id_pool
 
 
-def get_columns(table_name: str, args: argparse.Namespace) -> list:
+def load_or_generate_pool_of_ids(key: str, col_name: str, table: str, year: int, data_model: int,
+                                 session: DatabaseSession, manifest, sampled: bool = False,
+                                 run_key: bytes = None) -> np.ndarray:
     """
-    Fetches the names of all columns for the specific table (Satzart).
+    Returns the pool of new ids persisted by an earlier run, or generates and persists a new one
 
     Parameters:
-        table_name (str): The name of the current table
-        args (argparse.Namespace): Dictionary containing command line arguments
+        key (str): The name of the pool
+        col_name (str): The name of the column
+        table (str): The name of the current table (Satzart)
+        year (int): The year of the data
+        data_model: The data model of the current table
+        session (DatabaseSession): The database session of the current process
+        manifest (RunManifest): The manifest of the current run
+        sampled (bool): Whether only the distinct ids of the sampled persons are counted
+        run_key (bytes): The key of the random streams of the run, None for the secure source of randomness
 
     Returns:
-        columns (list): A list of column names from the specified table
+        id_pool (numpy.ndarray): Fixed-width byte strings of unique, randomly generated pseudonyms
     """
+    id_pool = manifest.load_pool(key)
+    if id_pool is None:
+        id_pool = generate_pool_of_ids(col_name, table, year, data_model, session, sampled, run_key)
+        manifest.save_pool(key, id_pool)
+    return id_pool
 
-    try:
-        connection, cursor = connect_to_database(
-            dsn=args.dsn, 
-            username=args.username, 
-            password=args.password,
-            data_model=data_model)
-    except Exception as e:
-        raise e
-    else:
-        if args.dsn == "sqlite":
-            info_query = f"PRAGMA table_info({table_name})"
-            df_info = pd.read_sql_query(info_query, con=connection)
-            columns = list(df_info.name)
-        elif args.dsn == "oracle":
-            info_query = f"SELECT * FROM {table_name} FETCH FIRST 2 ROWS ONLY"
-            cursor.execute(info_query)
-            columns = [col[0] for col in cursor.description if col[0] != 'index']
-        else:
-            sys.exit("SQL dialect not supported. Choose from sqlite or oracle")
-    finally:
-        connection.close()
 
-    return columns
+class ColumnJob(NamedTuple):
+    """A column on its way through the stages fetch, anonymize and write of process_column."""
+    table: str
+    e: int
+    col: str
+    pool_descriptors: dict
+    args: argparse.Namespace
+    n: int
+    begin: datetime
+    data: object = None  # the fetched, then the processed values of the column
+    spill_file: Path | list | None = None  # set if the column was processed by an earlier run or out of core
+    finished: bool = False  # whether the column was processed by an earlier run
 
 
-def process_data(arguments):
+def fetch_column(arguments) -> ColumnJob:
     """
-    Fetches original data from database, processes it by applying random shuffling and k-anonymity
-    and writes it column-wise into csv files.
+    Fetches the original data of one column from database. Columns which are generated from the pool of ids or
+    shuffled out of core are fetched by anonymize_column.
 
     Parameters:
-        arguments (tuple): Contains the table name to process (str) and the command line arguments
+        arguments (tuple): Contains the table name (str), the position of the column in the table (int), the column
+        name (str), the descriptors of the id pools in shared memory (dict) and the command line arguments
         (argparse.Namespace), including year and dsn connection
+
+    Returns:
+        job (ColumnJob): The column with the fetched data
+    """
+
+    table, e, col, pool_descriptors, args = arguments
+    begin = datetime.now()
+    data_model: int = get_data_model_from_year(args.year)
+    table_name = get_source_table(table, args)
+    session = get_session(args.dsn, args.username, args.password, data_model)
+    job = ColumnJob(*arguments, n=session.count_rows(table_name), begin=begin)
+    manifest = get_manifest(args.year, K, sample_fraction=args.sample_fraction)
+    finished = manifest.finished("column", table, col, rows=job.n)
+    if finished is not None:
+        print(f"{col} of {table_name} was already processed and is skipped.")
+        return job._replace(spill_file=finished, finished=True)
+
+    if col in get_constant_variables(data_model=data_model):
+        with span("fetch", args.year, table, col, rows=job.n):
+            return job._replace(data=pd.Series([session.first_value(table_name, col)] * job.n))
+    if get_schema().is_pseudo(data_model, col) or (args.memory_limit is not None and not args.histogram):
+        return job
+
+    data_type = get_data_type(col, data_model=data_model)
+    with session.connect() as (connection, cursor):
+        if args.histogram:  # get the histogram of the column, the rows are generated from it
+            with span("fetch", args.year, table, col) as record:
+                values, counts = read_histogram(cursor, table_name, col, data_type)
+                record["rows"] = record["distinct"] = len(values)
+            return job._replace(data=(values, counts))
+
+        with span("fetch", args.year, table, col, rows=job.n):
+            return job._replace(data=read_column(cursor, table_name, col, data_type, n_rows=job.n,
+                                                 ordered=args.run_key_file is not None))
+
+
+def anonymize_column(job: ColumnJob) -> ColumnJob:
+    """
+    Processes the fetched data of one column by applying random shuffling and k-anonymity. Columns shuffled out of
+    core are fetched, processed and spilled bucket by bucket.
+
+    Parameters:
+        job (ColumnJob): The column with the fetched data
+
+    Returns:
+        job (ColumnJob): The column with the processed data
     """
 
-    table, mapping, args = arguments
+    table, e, col, pool_descriptors, args, n = job[:6]
+    if job.finished:
+        return job
     data_model: int = get_data_model_from_year(args.year)
-    dtypes = get_data_types(data_model=data_model)
-    prefix = get_prefix(table, data_model)
+    data_type = get_data_type(col, data_model=data_model)
+
+    if col in get_constant_variables(data_model=data_model):
+        return job
+
+    if get_schema().is_pseudo(data_model, col):
+        with span("pseudo", args.year, table, col, rows=n):
+            key = col[col.find("_") + 1:]
+            pool = attach_pools(pool_descriptors)[key]
+            stream = get_stream(args.run_key, args.year, table, col, "pseudo")
+            if table in ['SA151', 'SA152', 'SA751', 'SA131', 'VERS']:
+                # every member of the pool first, the remaining rows are sampled from the pool
+                data = np.concatenate([pool[:n], sample_from_pool(pool, max(n - len(pool), 0), stream)])
+            else:
+                data = sample_from_pool(pool, n, stream)
+            return job._replace(data=pd.Series(np.char.decode(data, 'ascii')))
+
+    if args.histogram:
+        values, counts = job.data
+
+        # 0) clean the distinct values
+        with span("clean", args.year, table, col, rows=len(values)):
+            values = clean_data(values, data_type)
+
+        # 1) + 2) apply k-anonymity to the histogram and repeat the values in random order
+        with span("k", args.year, table, col, rows=n):
+            return job._replace(data=force_k_from_histogram(values, counts, data_type, k=K,
+                                                            stream=get_stream(args.run_key, args.year, table, col,
+                                                                              "shuffle")))
+
+    if args.memory_limit is not None:  # get data and shuffle it out of core
+        spill_dir: Path = get_output_dir(args.year) / table
+        bucket_dir: Path = spill_dir / f"buckets_{e}"
+        bucket_dir.mkdir(parents=True, exist_ok=True)
+        session = get_session(args.dsn, args.username, args.password, data_model)
+        # fetching and cleaning are part of the pass scattering the column into the buckets
+        with session.connect() as (connection, cursor), span("shuffle", args.year, table, col, rows=n) as record:
+            chunks = (clean_data(pd.Series(chunk), data_type)
+                      for chunk in iter_column_chunks(cursor, get_source_table(table, args), col,
+                                                      ordered=args.run_key_file is not None))
+            counts, buckets = external_shuffle(chunks, n, bucket_dir, args.memory_limit * 1024 ** 2,
+                                               get_stream(args.run_key, args.year, table, col, "shuffle"))
+            record["distinct"] = len(counts)
+
+        # 1) + 2) every bucket is shuffled and k-anonymity applied with the counts of the whole column
+        spill_file = []
+        for i, bucket in enumerate(buckets):
+            with span("k", args.year, table, col, rows=len(bucket)):
+                bucket = force_k(bucket, data_type, k=K, counts=counts)
+            # 3) spill every bucket into its own binary file
+            with span("spill", args.year, table, col, rows=len(bucket)):
+                spill_file.append(spill_column(bucket, spill_dir / f"{e}_{col}_{i}.npy", data_type))
+        return job._replace(data=None, spill_file=spill_file)
+
+    # 0) clean column
+    with span("clean", args.year, table, col, rows=n) as record:
+        data = clean_data(job.data, data_type)
+        record["distinct"] = int(data.nunique(dropna=False))
+
+    # 1) randomly shuffle the column
+    with span("shuffle", args.year, table, col, rows=n):
+        data = shuffle_column(data, get_stream(args.run_key, args.year, table, col, "shuffle"))
+
+    # 2) apply k-anonymity
+    with span("k", args.year, table, col, rows=n):
+        return job._replace(data=force_k(data, data_type, k=K))
+
+
+def write_column(job: ColumnJob):
+    """
+    Spills the processed data of one column into a binary file and records it in the manifest of the run.
+
+    Parameters:
+        job (ColumnJob): The column with the processed data
+
+    Returns:
+        year (int): The year of the processed table
+        table (str): The name of the processed table
+        e (int): The position of the column in the table
+        spill_file (Path | list): The binary file of the column, or one file per bucket if shuffled out of core
+        seconds (float | None): The processing time of the column, None if it was processed by an earlier run
+    """
+
+    table, e, col, pool_descriptors, args, n = job[:6]
+    if job.finished:
+        return args.year, table, e, job.spill_file, None
+    if job.spill_file is not None:
+        spill_file = job.spill_file
+    else:
+        # 3) spill the column once into its own binary file
+        spill_dir: Path = get_output_dir(args.year) / table
+        spill_dir.mkdir(parents=True, exist_ok=True)
+        data_type = get_data_type(col, data_model=get_data_model_from_year(args.year))
+        with span("spill", args.year, table, col, rows=n):
+            spill_file = spill_column(job.data, spill_dir / f"{e}_{col}.npy", data_type)
+    manifest = get_manifest(args.year, K, sample_fraction=args.sample_fraction)
+    manifest.record("column", table, col, rows=n, files=spill_file if isinstance(spill_file, list) else [spill_file])
 
-    table_name = f"{prefix}{args.year}{table}"
-    columns = get_columns(table_name, args)
+    return args.year, table, e, spill_file, (datetime.now() - job.begin).total_seconds()
 
-    # create output directory, if it doesn't exist
-    out_dir_path_name: str = "output_csv"
-    out_dir: Path = Path(out_dir_path_name)
-    out_dir.mkdir(exist_ok=True)
+
+def process_column(arguments):
+    """
+    Fetches the original data of one column from database, processes it by applying random shuffling and
+    k-anonymity and spills it into binary files.
+
+    Parameters:
+        arguments (tuple): Contains the table name (str), the position of the column in the table (int), the column
+        name (str), the descriptors of the id pools in shared memory (dict) and the command line arguments
+        (argparse.Namespace), including year and dsn connection
+
+    Returns:
+        year (int): The year of the processed table
+        table (str): The name of the processed table
+        e (int): The position of the column in the table
+        spill_file (Path | list): The binary file of the column, or one file per bucket if shuffled out of core
+        seconds (float | None): The processing time of the column, None if it was processed by an earlier run
+    """
+
+    table, e, col, pool_descriptors, args = arguments
+    profile_file = get_output_dir(args.year) / "profiles" / f"{table}_{col}.prof"
+    with profile_column(args.profile, profile_file):
+        return write_column(anonymize_column(fetch_column(arguments)))
+
+
+def process_columns_overlapped(tasks: list, depth: int = PIPELINE_DEPTH) -> list:
+    """
+    Processes the columns of a table in a pipeline: a prefetch thread fetches the next columns from the database
+    while the current column is processed, and a writer thread spills the processed columns. At most depth
+    columns wait for each of the two threads, so that at most 2 * depth + 1 columns are held in memory.
+
+    Parameters:
+        tasks (list): The arguments of process_column of every column
+        depth (int): The number of columns fetched in advance and waiting to be spilled
+
+    Returns:
+        spill_files (list): The spill files of every column, in the order of tasks
+    """
+    spill_files = []
+    with ThreadPoolExecutor(max_workers=1) as fetcher, ThreadPoolExecutor(max_workers=1) as writer:
+        fetches = deque(fetcher.submit(fetch_column, task) for task in tasks[:depth])
+        writes = deque()
+        for i in range(len(tasks)):
+            job = fetches.popleft().result()
+            if i + depth < len(tasks):
+                fetches.append(fetcher.submit(fetch_column, tasks[i + depth]))
+            job = anonymize_column(job)
+            if len(writes) == depth:
+                spill_files.append(writes.popleft().result()[3])
+            writes.append(writer.submit(write_column, job))
+            del job
+        spill_files += [write.result()[3] for write in writes]
+    return spill_files
+
+
+def assemble_table(table: str, columns: list, spill_files: list, args: argparse.Namespace):
+    """
+    Merges the spilled columns of a table into one csv file in one pass, exports them in every format of
+    args.export, each in one more pass, and removes the binary files.
+
+    Parameters:
+        table (str): The name of the table (Satzart)
+        columns (list): The column names of the table
+        spill_files (list): The binary files of every column in the order of the columns
+        args (argparse.Namespace): Dictionary containing command line arguments
+    """
+    csv_final: Path = get_output_dir(args.year) / f"{table}.csv"
+    with span("merge", args.year, table) as record:
+        record["rows"] = merge_spilled_columns(spill_files, columns, csv_final)
+    export_files = []
+    dtypes = get_data_types(data_model=get_data_model_from_year(args.year))
+    for export_format in args.export:
+        export_files.append(csv_final.with_name(f"{table}{EXPORT_FORMATS[export_format]}"))
+        with span("export", args.year, table) as record:
+            record["rows"] = export_spilled_columns(spill_files, columns, [dtypes.get(col) for col in columns],
+                                                    export_files[-1], export_format)
+    get_manifest(args.year, K, sample_fraction=args.sample_fraction).record("table", table,
+                                                                          files=[csv_final] + export_files)
+    shutil.rmtree(csv_final.parent / table, ignore_errors=True)
+
+
+def process_data(arguments):
+    """
+    Fetches original data from database, processes it by applying random shuffling and k-anonymity,
+    spills it column-wise into binary files and merges these into one csv file.
+
+    Parameters:
+        arguments (tuple): Contains the table name to process (str), the descriptors of the id pools in shared
+        memory (dict) and the command line arguments (argparse.Namespace), including year and dsn connection
+
+    Returns:
+        table (str): The name of the processed table
+    """
+
+    table, pool_descriptors, args = arguments
+    data_model: int = get_data_model_from_year(args.year)
+    table_name = get_source_table(table, args)
+    columns = get_session(args.dsn, args.username, args.password, data_model).get_columns(table_name)
 
     # get single column and process it
     # this is needed due to memory issues
     # whole tables cannot be loaded and stored in a pandas dataframe
-    for e, col in enumerate(columns):
-        try:
-            connection, cursor = connect_to_database(
-                dsn=args.dsn, 
-                username=args.username, 
-                password=args.password,
-                data_model=data_model)
-        except Exception as e:
-            raise e
-        else:
-            if col in get_constant_variables(data_model=data_model):
-                cursor.execute(f"SELECT {col} from {table_name} LIMIT 1")
-                data = pd.Series([entry[0] for entry in cursor.fetchall()])
-                cursor.execute(f"SELECT COUNT(*) from {table_name}")
-                n = cursor.fetchall()[0][0]
-                data = pd.Series([data[0]] * n)
-
-            elif col in get_pseudo_variables(data_model=data_model):
-                cursor.execute(f"SELECT COUNT(*) from {table_name}")
-                n = cursor.fetchall()[0][0]
-                key = col[col.find("_") + 1:]
-                if table in ['SA151', 'SA152', 'SA751', 'SA131', 'VERS']:
-                    data = pd.Series(mapping[key]
-                                    + [random.choice(mapping[key]) for _ in
-                                        range(n - len(mapping[key]))])
-                else:
-                    data = pd.Series([random.choice(mapping[key]) for _ in range(n)])
-
-            else:  # get data
-                begin = datetime.now()
-                cursor.execute(f"SELECT {col} from {table_name}")
-                data = pd.Series([entry[0] for entry in cursor.fetchall()])
-                print(f"Fetching {col} data from {table_name} took {datetime.now() - begin}")
-
-                # 0) clean column
-                begin = datetime.now()
-                data_type = dtypes[col]
-                data = clean_data(data, data_type)
-                print(f"Cleaning {col} took {datetime.now() - begin}.")
-
-                # 1) randomly shuffle the column
-                begin = datetime.now()
-                data = shuffle_column(data)  # overwrite data in columns new order
-                print(f"Data shuffling for {col} took {datetime.now() - begin}.")
-
-                # 2) apply k-anonymity
-                begin = datetime.now()
-                data = force_k(data, data_type, k=K)
-                print(f"K-anonymity for {col} took {datetime.now() - begin}.")
-
-        finally:
-            connection.close()
-
-        # 3) write data into csv files
-        
-        csv_file_out: Path = out_dir / f"{table}_{e}.csv"
-        csv_file_in: Path = out_dir / f"{table}_{e-1}.csv"
-        csv_final: Path = out_dir / f"{table}.csv"
-
-        if e == 0:
-            with csv_file_out.open("w", newline="") as f:
-                writer = csv.writer(f, delimiter=",")
-                writer.writerow([col])
-                for data_row in data:
-                    writer.writerow([data_row])
-        else:
-            with csv_file_in.open("r") as f_in, csv_file_out.open("w", newline="") as f_out:
-                csv_reader: csv.reader = csv.reader(f_in, delimiter=",")
-                writer: csv.writer = csv.writer(f_out, delimiter=",")
-                writer.writerow(next(csv_reader) + [col])
-                for csv_row, data_row in zip(csv_reader, data):
-                    csv_row.append(data_row)
-                    writer.writerow(csv_row)
-            csv_file_in.unlink(missing_ok=True)
-    
-    # rename fails on windows systems if the target file exists
-    if csv_final.exists():
-        csv_final.unlink()
-    
-    csv_file_out.rename(csv_final)
-    
-    return None
+    tasks = [(table, e, col, pool_descriptors, args) for e, col in enumerate(columns)]
+    if args.profile is not None:  # every column is profiled on its own
+        spill_files = [process_column(task)[3] for task in tasks]
+    else:  # the database and the disk work while the columns are processed
+        spill_files = process_columns_overlapped(tasks)
 
+    # 4) merge all columns into the final csv file in one pass
+    assemble_table(table, columns, spill_files, args)
 
-def write_to_database(table: str, args: argparse.Namespace):
+    return table
+
+
+def plan_column_tasks(tables: list, pool_descriptors: dict, args: argparse.Namespace,
+                      session: DatabaseSession) -> tuple[list, dict]:
     """
-    Loads data from CSV files and writes them to the SQLite database.
+    Splits the tables into one task per column, in the order of the tables and their columns.
+    The tasks are ordered by the estimates of the planner, see estimate_tasks.
 
     Parameters:
-        table (str): The name of the table to process (str).
+        tables (list): The names of the tables (Satzart) to process
+        pool_descriptors (dict): The descriptors of the id pools in shared memory
+        args (argparse.Namespace): Dictionary containing command line arguments
+        session (DatabaseSession): The database session of the current process
+
+    Returns:
+        tasks (list): The arguments of process_column for every column
+        table_columns (dict): The column names of every table
     """
-    data_model: int = get_data_model_from_year(args.year)
-    table_name = f"{get_prefix(table, data_model)}{args.year}{table}_puf"
-    cnxn, cur = connect_to_database(
-        dsn=args.dsn, 
-        username=args.username, 
-        password=args.password,
-        data_model=data_model)
-
-    csv_file: Path = Path(f"output_csv/{table}.csv")
-    with csv_file.open("r") as f:
-        reader = csv.reader(f, delimiter=",")
-        for i, row in enumerate(reader):
-            if i == 0:
-                cols = row
-            else:
-                insert_query = f"INSERT INTO {table_name} {tuple(cols)} values {tuple(['?' for i in range(len(cols))])}"
-                insert_query = insert_query.replace("'", "")
-                cur.execute(insert_query, row)
-    cnxn.commit()
-    cnxn.close()
+    tasks, table_columns = [], {}
+    for table in tables:
+        table_columns[table] = session.get_columns(get_source_table(table, args))
+        tasks += [(table, e, col, pool_descriptors, args) for e, col in enumerate(table_columns[table])]
+    return tasks, table_columns
 
-def get_data_model_from_year(year: int) -> int:
-    """Return data model depending on year
+
+def estimate_tasks(tasks: list, calibration: dict, count_distinct: bool = False) -> list:
+    """
+    Estimates peak memory and processing time of every column task.
 
     Parameters:
-        year (int): input year from command line
+        tasks (list): The arguments of process_column for every column, possibly of several years
+        calibration (dict): The time per row of every data type
+        count_distinct (bool): Whether to count the distinct values of every shuffled column in the database
+
+    Returns:
+        estimates (list): The estimate of every task
     """
-    last_year_with_data_model_2: int = 2018
-    return 2 if year <= last_year_with_data_model_2 else 3
+    estimates = []
+    for table, e, col, _, args in tasks:
+        data_model: int = get_data_model_from_year(args.year)
+        session = get_session(args.dsn, args.username, args.password, data_model)
+        table_name = get_source_table(table, args)
+        data_type = 'constant' if col in get_constant_variables(data_model=data_model) \
+            else get_data_type(col, data_model=data_model)
+        distinct = session.count_distinct(table_name, col) \
+            if count_distinct and data_type not in ('constant', 'pseudo') else None
+        memory_limit = args.memory_limit * 1024 ** 2 if args.memory_limit is not None else None
+        estimates.append(estimate_column(table_name, col, data_type, session.count_rows(table_name), distinct,
+                                         calibration, memory_limit))
+    return estimates
+
+
+def get_tables(data_model: int) -> tuple[list, str]:
+    """
+    Returns the tables (Satzarten) of a data model and the script creating their _puf tables
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description="Script to generate the public use file for DM1/2")
-    parser.add_argument("--dsn", default="sqlite", help="Data source name for ODBC data source, default: sqlite")
-    parser.add_argument("--username", default="fdz", help="Username to connect to database, default: fdz")
-    parser.add_argument("--password", default="fdz", help="Password to connect to database, default: fdz")
-    default_year: int = 2016
-    parser.add_argument("--year", default=default_year, type=int, help=f"Year for data creation, default: {default_year}")
-    parser.add_argument("--multi_threading", action='store_true', help="Whether to parallelize the code in multiple "
-                                                                       "threads, default: False")
+    Parameters:
+        data_model (int): The data model
+    Returns:
+        all_tables (list): The names of the tables
+        create_path (str): The sql script creating the _puf tables
+    """
+    if data_model == 2:
+        all_tables = ["SA151", "SA131", "SA152", "SA153", "SA551", "SA651", "SA751", "SA951", "SA451"]
+        create_path = "create_puf_tables.sql"
+    else:
+        all_tables = ["VERS", "VERSQ", "VERSQDMP", "REZ", "AMBFALL", "KHFALL", "ZAHNFALL",
+                      "AMBDIAG", "AMBOPS", "AMBLEIST", "KHFA", "KHENTG", "KHDIAG", "KHPROZ",
+                      "ZAHNLEIST", "ZAHNBEF", "EZD"]
+        create_path = "create_puf_tables_dm3.sql"
+    return all_tables, create_path
 
-    args = parser.parse_args()
-    # get data model
+
+def create_sample(tables: list, args: argparse.Namespace, session: DatabaseSession, manifest):
+    """
+    Draws a simple random sample without replacement of the person ids of a year and creates a view of every table
+    with the rows of the sampled persons. The sample is drawn from the secure source of randomness while the
+    distinct person ids are streamed from the database, and it is kept in a table of the database, so that only
+    the rows of the sampled persons are fetched. A resumed run reuses the sample.
+
+    Parameters:
+        tables (list): The names of the tables (Satzart) to read from the sample
+        args (argparse.Namespace): Dictionary containing command line arguments, including year and sample fraction
+        session (DatabaseSession): The database session of the current process
+        manifest (RunManifest): The manifest of the current run
+    """
     data_model: int = get_data_model_from_year(args.year)
+    person_table, person_column = ("SA151", "SA151_PSID") if data_model == 2 else ("VERS", "PSID")
+    person_table_name = f"{get_prefix(person_table, data_model)}{args.year}{person_table}"
+    sample_table = f"PUF_SAMPLE_{args.year}"
+    with session.connect() as (cnxn, cur):
+        if manifest.finished("sample", sample_table) is None:
+            if args.dsn == "oracle":
+                cur.execute(f"BEGIN EXECUTE IMMEDIATE 'DROP TABLE {sample_table}'; "
+                            f"EXCEPTION WHEN OTHERS THEN NULL; END;")
+            else:
+                cur.execute(f"DROP TABLE IF EXISTS {sample_table}")
+            cur.execute(f"CREATE TABLE {sample_table} AS SELECT {person_column} PSID FROM {person_table_name} "
+                        f"WHERE 1 = 0")
+            n_persons = session.count_distinct(person_table_name, person_column)
+            sample = draw_sample(n_persons, args.sample_fraction,
+                                 get_stream(args.run_key, args.year, sample_table, person_column, "sample"))
+            # the n-th distinct person id is sampled if n is in the sample
+            persons = f"(SELECT DISTINCT {person_column} FROM {person_table_name} WHERE {person_column} IS NOT NULL) p"
+            start = 0
+            # sorted, so that a run key selects the same persons in every run
+            for chunk in iter_column_chunks(cnxn.cursor(), persons, person_column, ordered=True):
+                stop = np.searchsorted(sample, start + len(chunk))
+                selected = sample[np.searchsorted(sample, start):stop] - start
+                cur.executemany(f"INSERT INTO {sample_table} (PSID) VALUES (?)", [(chunk[i],) for i in selected])
+                start += len(chunk)
+            cnxn.commit()
+            manifest.record("sample", sample_table, rows=len(sample))
+            print(f"{len(sample)} of {n_persons} persons of {args.year} are sampled.")
+
+        for table in tables:
+            table_name = f"{get_prefix(table, data_model)}{args.year}{table}"
+            id_column = f"{table}_PSID" if data_model == 2 else "PSID"
+            query = f"SELECT * FROM {table_name} WHERE {id_column} IN (SELECT PSID FROM {sample_table})"
+            if args.dsn == "oracle":
+                cur.execute(f"CREATE OR REPLACE VIEW {table_name}_sample AS {query}")
+            else:
+                cur.execute(f"DROP VIEW IF EXISTS {table_name}_sample")
+                cur.execute(f"CREATE VIEW {table_name}_sample AS {query}")
+        cnxn.commit()
 
-    begin = datetime.now()
-    # connect to database:
-    cnxn, cur = connect_to_database(
-        dsn=args.dsn, 
-        username=args.username, 
-        password=args.password,
-        data_model=data_model)
+
+def prepare_year(args: argparse.Namespace) -> tuple[list, dict, list]:
+    """
+    Generates the id pools of a year, or loads them when resuming, and drops and creates its _puf tables.
+
+    Parameters:
+        args (argparse.Namespace): Dictionary containing command line arguments, with the year to prepare
+
+    Returns:
+        all_tables (list): The tables of the year which are not loaded yet
+        id_pool_mapping (dict): The id pool of every pseudonymized variable
+        merged_tables (list): The tables of the year which are merged into a csv file, but not loaded yet
+    """
+    data_model: int = get_data_model_from_year(args.year)
+    session = get_session(args.dsn, args.username, args.password, data_model)
+    all_tables, create_path = get_tables(data_model)
+
+    # finished work of an interrupted run is only reused with --resume
+    manifest = get_manifest(args.year, K, sample_fraction=args.sample_fraction)
+    if not args.resume:
+        manifest.clear()
+    loaded_tables = [table for table in all_tables if manifest.finished("loaded", table) is not None]
+    if loaded_tables:
+        print(f"The tables {', '.join(loaded_tables)} of {args.year} were already loaded and are skipped.")
+    all_tables = [table for table in all_tables if table not in loaded_tables]
+
+    # only the rows of the sampled persons are read, and the pools are sized by their distinct ids
+    sampled = args.sample_fraction is not None
+    if sampled:
+        create_sample(all_tables, args, session, manifest)
 
     # get pool for all person ids:
 
     if data_model == 2:
-        psid_pool = generate_pool_of_ids("SA151_PSID", "SA151", data_model)
-        vsid_pool = generate_pool_of_ids("SA151_VSID", "SA151", data_model)
+        psid_pool = load_or_generate_pool_of_ids("PSID", "SA151_PSID", "SA151", args.year, data_model, session,
+                                                manifest, sampled, args.run_key)
+        vsid_pool = load_or_generate_pool_of_ids("VSID", "SA151_VSID", "SA151", args.year, data_model, session,
+                                                manifest, sampled, args.run_key)
         id_pool_mapping = {"PSID": psid_pool, "VSID": vsid_pool}
     else:
         pseudo_mapping = get_pseudo_mapping(data_model=data_model)
         id_pool_mapping = {key: [] for key in pseudo_mapping.keys()}
         for col in id_pool_mapping.keys():
             if col not in get_secondary_pools_dm3().keys():
-                id_pool_mapping[col] = generate_pool_of_ids(col, pseudo_mapping[col], data_model)
+                id_pool_mapping[col] = load_or_generate_pool_of_ids(col, col, pseudo_mapping[col], args.year,
+                                                                    data_model, session, manifest, sampled,
+                                                                    args.run_key)
         for key, value in get_secondary_pools_dm3().items():
             id_pool_mapping[key] = id_pool_mapping[value]
 
-
     # drop all tables and create new ones - needed for testing purposes
-    if data_model == 2:
-        all_tables = ["SA151", "SA131", "SA152", "SA153", "SA551", "SA651", "SA751", "SA951", "SA451"]
-        create_path = "create_puf_tables.sql"
-    else:
-        all_tables = ["VERS", "VERSQ", "VERSQDMP", "REZ", "AMBFALL", "KHFALL", "ZAHNFALL",
-                      "AMBDIAG", "AMBOPS", "AMBLEIST", "KHFA", "KHENTG", "KHDIAG", "KHPROZ",
-                      "ZAHNLEIST", "ZAHNBEF", "EZD"]
-        create_path = "create_puf_tables_dm3.sql"
     if data_model == 3:
         drop_all = " ".join([f"DROP TABLE IF EXISTS BJ{args.year}{table}_puf;" for table in all_tables])
     else:
         drop_all = " ".join(
             [f"DROP TABLE IF EXISTS {get_prefix(table, data_model)}{args.year}{table}_puf;" for table in all_tables])
-    cur.executescript(drop_all)
 
     # generate new tables
     with open(create_path, "r") as f_tables:
         sql_create_tables = f_tables.read().format(prefix="BJ" if data_model == 3 else "VBJ", receiving_year=args.year,
                                                    clearing_year=int(args.year) - 1,
                                                    schema="puf")
-    cur.executescript(sql_create_tables)
-    cnxn.close()
+    # only the tables which are not loaded yet are created again
+    create_tables = [statement for statement in sql_create_tables.split(";")
+                     if any(f'"{get_prefix(table, data_model)}{args.year}{table}_puf"' in statement
+                            for table in all_tables)]
+    with session.connect() as (cnxn, cur):
+        cur.executescript(drop_all)
+        cur.executescript(";".join(create_tables) + ";" if create_tables else "")
 
-    if args.multi_threading:
-        num_processes = min(len(all_tables), cpu_count())
-        print(f"Multi-threading is used with {num_processes} processes.")
-        with Pool(num_processes) as pool:
-            pool.map(process_data, [(table, id_pool_mapping, args) for table in all_tables])
-    else:
-        for table in all_tables:
-            process_data((table, id_pool_mapping, args))
+    merged_tables = [table for table in all_tables if manifest.finished("table", table) is not None]
+    return all_tables, id_pool_mapping, merged_tables
 
 
-    # load csv files and insert data into database line by line
-    # this is needed when working with the real data because the tables cannot be loaded into the memory at once
-    for table in all_tables:
-        print(f"Writing table {table} to database.")
-        write_to_database(table, args=args)
+def write_to_database(table: str, args: argparse.Namespace):
+    """
+    Loads data from CSV files and writes them to the database in batches.
+
+    Parameters:
+        table (str): The name of the table to process (str).
+        args (argparse.Namespace): Dictionary containing command line arguments
+    """
+    data_model: int = get_data_model_from_year(args.year)
+    table_name = f"{get_prefix(table, data_model)}{args.year}{table}_puf"
+    session = get_session(args.dsn, args.username, args.password, data_model)
+
+    n_rows = 0
+    csv_file: Path = get_output_dir(args.year) / f"{table}.csv"
+    # the pragmas of SQLite are set on a connection of its own, so that they do not stay in effect for later writes
+    # into the database with the original data
+    connect = session.connect_unpooled if args.dsn == "sqlite" else session.connect
+    with span("load", args.year, table) as record, connect() as (cnxn, cur), csv_file.open("r", newline="") as f:
+        if args.dsn == "oracle":
+            # bind each batch as parameter arrays instead of one round trip per row
+            cur.fast_executemany = True
+        elif args.dsn == "sqlite":
+            # all batches are inserted in one transaction, which is committed at the end
+            cur.execute("PRAGMA synchronous = OFF")
+            cur.execute("PRAGMA journal_mode = MEMORY")
+        reader = csv.reader(f, delimiter=",")
+        cols = next(reader)
+        insert_query = f"INSERT INTO {table_name} ({', '.join(cols)}) values ({', '.join(['?'] * len(cols))})"
+        while batch := list(islice(reader, BATCH_SIZE)):
+            cur.executemany(insert_query, batch)
+            n_rows += len(batch)
+        cnxn.commit()
+        record["rows"] = n_rows
+    get_manifest(args.year, K, sample_fraction=args.sample_fraction).record("loaded", table, rows=n_rows)
 
+
+def get_data_model_from_year(year: int) -> int:
+    """Return data model depending on year
+
+    Parameters:
+        year (int): input year from command line
+    """
+    last_year_with_data_model_2: int = 2018
+    return 2 if year <= last_year_with_data_model_2 else 3
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Script to generate the public use file for DM1/2")
+    parser.add_argument("--dsn", default="sqlite", help="Data source name for ODBC data source, default: sqlite")
+    parser.add_argument("--username", default="fdz", help="Username to connect to database, default: fdz")
+    parser.add_argument("--password", default="fdz", help="Password to connect to database, default: fdz")
+    parser.add_argument("--sqlite_file", default=None,
+                        help="SQLite database file, e.g. generated by generate_test_data.py, default: "
+                             "dm3_testdaten.sqlite for DM3, test_data/fdz_generated_data_dm12.db for DM1/2")
+    default_year: int = 2016
+    parser.add_argument("--year", default=default_year, type=int, help=f"Year for data creation, default: {default_year}")
+    parser.add_argument("--years", default=None, type=int, nargs='+',
+                        help="Several years for data creation in one run, replaces --year, default: None")
+    parser.add_argument("--multi_threading", action='store_true', help="Whether to parallelize the code in multiple "
+                                                                       "threads, default: False")
+    parser.add_argument("--memory_limit", default=None, type=int,
+                        help="Shuffle columns out of core in buckets of at most this size in MB, default: in memory")
+    parser.add_argument("--histogram", action='store_true',
+                        help="Fetch only the frequencies of the distinct values of every column and generate the "
+                             "shuffled, k-anonymous column from them, default: False")
+    parser.add_argument("--memory_budget", default=None, type=int,
+                        help="Run columns in parallel only while their estimated memory stays within this budget "
+                             "in MB, default: no budget")
+    parser.add_argument("--plan", action='store_true', help="Print the estimated memory and run time of every table "
+                                                            "without processing any data, default: False")
+    parser.add_argument("--sample_fraction", default=None, type=float,
+                        help="Process only a simple random sample of this fraction of the persons, e.g. 0.01, "
+                             "default: all persons")
+    parser.add_argument("--resume", action='store_true', help="Resume an interrupted run, reusing its id pools and "
+                                                              "all finished columns and tables, default: False")
+    parser.add_argument("--profile", default=None, choices=["cprofile", "tracemalloc"],
+                        help="Profile every column with cProfile, or record its traced peak memory with tracemalloc, "
+                             "default: None")
+    parser.add_argument("--export", default=[], nargs='+', choices=list(EXPORT_FORMATS),
+                        help="Export the final tables also as typed parquet or arrow files, or as compressed csv "
+                             "files, default: None")
+    parser.add_argument("--run_key_file", default=None,
+                        help="File with the secret key of all random streams, to reproduce a run. A new key is written "
+                             "into the file if it does not exist. The columns are then fetched sorted, so that their "
+                             "order does not depend on the database, default: a new key which is not written")
+
+    args = parser.parse_args()
+    if args.sqlite_file is not None:
+        os.environ[SQLITE_FILE_VARIABLE] = args.sqlite_file
+    check_export_formats(args.export)
+    # the key is passed to the worker processes, but never written into the report
+    args.run_key = load_or_generate_run_key(Path(args.run_key_file) if args.run_key_file else None)
+    if args.sample_fraction is not None and not 0 < args.sample_fraction <= 1:
+        parser.error("--sample_fraction must be greater than 0 and at most 1")
+    # every year is processed with its own arguments, the sessions of its data model are shared between the years
+    years_args = {year: argparse.Namespace(**{**vars(args), "year": year}) for year in (args.years or [args.year])}
+
+    begin = datetime.now()
+
+    # parse the schema once, forked worker processes inherit it
+    get_schema()
+
+    calibration = load_calibration()
+    num_processes = cpu_count() if args.multi_threading else 1
+    memory_budget = args.memory_budget * 1024 ** 2 if args.memory_budget is not None else None
+    if args.plan:
+        # the sample is not drawn yet, so the plan is made for all persons
+        tasks = []
+        for year, year_args in years_args.items():
+            year_args = argparse.Namespace(**{**vars(year_args), "sample_fraction": None})
+            data_model: int = get_data_model_from_year(year)
+            session = get_session(args.dsn, args.username, args.password, data_model)
+            tasks += plan_column_tasks(get_tables(data_model)[0], {}, year_args, session)[0]
+        print_plan(estimate_tasks(tasks, calibration, count_distinct=True), num_processes, memory_budget)
+        close_sessions()
+        sys.exit(0)
+
+    # load csv files and insert data into database in batches, as soon as a table is processed
+    # this is needed when working with the real data because the tables cannot be loaded into the memory at once
+    # place the id pools once in shared memory, the workers only receive their descriptors
+    prepared_years = {}
+    pool_blocks = []
+    clear_spans()
+    # the shared memory blocks are released also if the run fails, an interrupted run is continued with --resume
+    try:
+        for year, year_args in years_args.items():
+            all_tables, id_pool_mapping, merged_tables = prepare_year(year_args)
+            blocks, pool_descriptors = share_pools(id_pool_mapping)
+            pool_blocks += blocks
+            prepared_years[year] = (all_tables, pool_descriptors, merged_tables)
+
+        if args.multi_threading:
+            # every column of every year is a task of its own, idle processes take the next column from the queue
+            # with a memory budget, columns are only started while their estimated memory fits into the budget
+            tasks, table_columns = [], {}
+            for year, (all_tables, pool_descriptors, merged_tables) in prepared_years.items():
+                for table in merged_tables:
+                    write_to_database(table, args=years_args[year])
+                data_model: int = get_data_model_from_year(year)
+                open_tables = [table for table in all_tables if table not in merged_tables]
+                year_tasks, year_columns = plan_column_tasks(open_tables, pool_descriptors, years_args[year],
+                                                             get_session(args.dsn, args.username, args.password,
+                                                                         data_model))
+                tasks += year_tasks
+                table_columns.update({(year, table): columns for table, columns in year_columns.items()})
+            estimates = estimate_tasks(tasks, calibration, count_distinct=memory_budget is not None)
+            # the columns of all years are ordered by their estimated run time, largest first
+            order = sorted(range(len(tasks)), key=lambda i: estimates[i].seconds, reverse=True)
+            tasks, estimates = [tasks[i] for i in order], [estimates[i] for i in order]
+            estimates_by_column = {(task[4].year, task[0], task[1]): estimate
+                                   for task, estimate in zip(tasks, estimates)}
+            remaining_columns = {key: len(columns) for key, columns in table_columns.items()}
+            spill_files = {key: [None] * len(columns) for key, columns in table_columns.items()}
+            num_processes = max(min(len(tasks), num_processes), 1)
+            print(f"Multi-threading is used with {num_processes} processes for {len(tasks)} columns.")
+            with Pool(num_processes) as pool:
+                for year, table, e, spill_file, seconds in run_admitted(pool, process_column, tasks, estimates,
+                                                                        memory_budget):
+                    if seconds is not None:
+                        calibrate(calibration, estimates_by_column[(year, table, e)], seconds)
+                    spill_files[(year, table)][e] = spill_file
+                    remaining_columns[(year, table)] -= 1
+                    if remaining_columns[(year, table)] == 0:
+                        assemble_table(table, table_columns[(year, table)], spill_files[(year, table)],
+                                       years_args[year])
+                        write_to_database(table, args=years_args[year])
+        else:
+            for year, (all_tables, pool_descriptors, merged_tables) in prepared_years.items():
+                for table in all_tables:
+                    if table not in merged_tables:
+                        process_data((table, pool_descriptors, years_args[year]))
+                    write_to_database(table, args=years_args[year])
+    finally:
+        for block in pool_blocks:
+            block.close()
+            block.unlink()
+    close_sessions()
+    if args.multi_threading:
+        save_calibration(calibration)
+
+    report = write_report({**{key: value for key, value in vars(args).items() if key != "run_key"},
+                           "years": list(years_args), "start": begin.isoformat(),
+                           "wall_seconds": (datetime.now() - begin).total_seconds()})
+    for stage, summary in report["stages"].items():
+        print(f"{stage:<8}{summary['wall_seconds']:>10.1f} s{summary['cpu_seconds']:>10.1f} s CPU"
+              f"{summary['rows']:>12} rows{summary['rows_per_second'] or 0:>12.0f} rows/s")
     print(f"The whole process took {datetime.now() - begin}.")
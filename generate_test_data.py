@@ -0,0 +1,278 @@
+import re
+import sqlite3
+import argparse
+from pathlib import Path
+from datetime import datetime
+
+import numpy as np
+
+from schema import get_schema
+from helpers import get_constant_variables
+
+CHUNK_SIZE = 100_000
+DM2_CREATE_PATH = "create_tables.sql"
+# the checked-in DM3 test data only serves as template for the table definitions
+DM3_TEMPLATE = "dm3_testdaten.sqlite"
+DM3_TEMPLATE_YEAR = 2019
+# rows per insured person, as in the checked-in test data; tables missing here have one row per person
+ROWS_PER_PERSON = {2: {"SA451": 10, "SA551": 2, "SA651": 25},
+                   3: {"VERSQ": 4, "VERSQDMP": 1.3, "REZ": 1.8, "AMBFALL": 1.4, "KHFALL": 1.2, "ZAHNFALL": 2.7,
+                       "AMBDIAG": 5.3, "AMBOPS": 0.6, "AMBLEIST": 1.8, "KHFA": 3.1, "KHENTG": 1.2, "KHDIAG": 4.6,
+                       "KHPROZ": 0.4, "ZAHNLEIST": 6.3, "ZAHNBEF": 9, "EZD": 0.7}}
+# tables with exactly one row per insured person, which contain every person id
+PERSON_TABLES = ["SA151", "SA152", "SA153", "SA751", "SA951", "SA131", "VERS"]
+PERSON_POOLS = ["PSID", "VSID"]
+ICD_CHAPTERS = np.array(list("ABCDEFGHIJKLMNOPQRSTUVWXYZ"))
+
+
+def get_table_definitions(data_model: int, year: int) -> dict:
+    """
+    Returns the table definitions of a data model, DM1/2 from create_tables.sql and DM3 from the checked-in test data.
+
+    Parameters:
+        data_model (int): The data model
+        year (int): The year of the tables
+
+    Returns:
+        tables (dict): The create statement and the list of (column, sql type) of every table, by table name
+    """
+    tables = {}
+    if data_model == 2:
+        with open(DM2_CREATE_PATH, "r") as f_tables:
+            sql_create_tables = f_tables.read().format(prefix="VBJ", receiving_year=year, clearing_year=year - 1,
+                                                       schema="puf")
+        for statement in sql_create_tables.split(";"):
+            name = re.search(r'CREATE TABLE "(\w+)"', statement)
+            if name:
+                columns = re.findall(r'^\s*"(\w+)"\s+(\w+)', statement, flags=re.MULTILINE)
+                tables[name.group(1)] = (statement.strip() + ";", columns)
+    else:
+        template = sqlite3.connect(DM3_TEMPLATE)
+        for name, statement in template.execute("SELECT name, sql FROM sqlite_master WHERE type = 'table' "
+                                                f"AND name LIKE 'BJ{DM3_TEMPLATE_YEAR}%' AND name NOT LIKE '%_puf'"):
+            columns = [(row[1], row[2]) for row in template.execute(f"PRAGMA table_info({name})")]
+            tables[name.replace(str(DM3_TEMPLATE_YEAR), str(year), 1)] = (
+                statement.replace(str(DM3_TEMPLATE_YEAR), str(year), 1) + ";", columns)
+        template.close()
+    return tables
+
+
+def zipf_probabilities(cardinality: int, skew: float) -> np.ndarray:
+    """Return the probabilities of `cardinality` values, where the value of rank r has a weight of 1 / r ** skew."""
+    weights = np.arange(1, cardinality + 1, dtype=np.float64) ** -skew
+    return weights / weights.sum()
+
+
+def encode_dates(days: np.ndarray, year: int, resolution: str = 'D') -> np.ndarray:
+    """Return days of a year as integers of the form YYYYMMDD, or YYYYMM for a resolution of 'M'."""
+    dates = np.datetime64(f"{year}-01-01", 'D') + days
+    years = dates.astype('datetime64[Y]').astype(np.int64) + 1970
+    months = dates.astype('datetime64[M]').astype(np.int64) % 12 + 1
+    if resolution == 'M':
+        return years * 100 + months
+    return years * 10000 + months * 100 + (dates - dates.astype('datetime64[M]')).astype(np.int64) + 1
+
+
+def make_column_generator(column: str, sql_type: str, data_type: str, year: int, data_model: int,
+                          rng: np.random.Generator, cardinality: int, skew: float, rare: float, missing: float):
+    """
+    Builds the generator of the values of a column. Codes and probabilities are drawn once, so that all chunks of
+    a column follow the same distribution.
+
+    Parameters:
+        column (str): The name of the column
+        sql_type (str): The declared sql type of the column
+        data_type (str): The type of data as defined in `data_types.csv`, or 'constant'
+        year (int): The year of the data
+        data_model (int): The data model
+        rng (numpy.random.Generator): The random number generator
+        cardinality (int): The number of frequent distinct values of categorical and code columns
+        skew (float): The exponent of the zipf distribution of the frequent values
+        rare (float): The fraction of rows with a value of their own, i.e. values which occur only once
+        missing (float): The fraction of rows without value
+
+    Returns:
+        generator (callable): Function of the number of rows returning an array of values
+    """
+    text = sql_type.upper() in ("TEXT", "VARCHAR", "VARCHAR2")
+    n_rare = [0]
+
+    if data_type == 'constant':
+        value = year if column.endswith(("BJAHR", "BERICHTSJAHR")) else \
+            year - 1 if column.endswith("AUSGLEICHSJAHR") else \
+            data_model if column == "DATENMODELL" else int(column[2:5])
+        return lambda size: np.full(size, value)
+    if data_type in ('string', 'alphanumeric'):
+        # hierarchical codes like ICD or OPS codes, e.g. E110, with a few very frequent codes
+        codes = np.unique(np.char.add(np.char.add(rng.choice(ICD_CHAPTERS, cardinality),
+                                                  np.char.zfill(rng.integers(0, 100, cardinality).astype(str), 2)),
+                                      rng.integers(0, 10, cardinality).astype(str)))
+    elif data_type == 'float':
+        codes = np.round(rng.lognormal(4, 1.5, cardinality), 2)
+    else:
+        codes = np.arange(1, cardinality + 1)
+        if text:
+            codes = codes.astype(str)
+    probabilities = zipf_probabilities(len(codes), skew)
+
+    def generate(size: int) -> np.ndarray:
+        if data_type == 'date':
+            values = encode_dates(rng.integers(0, 365, size), year)
+        elif data_type == 'month':
+            values = encode_dates(rng.integers(0, 365, size), year, resolution='M')
+        elif data_type == 'year':
+            values = rng.integers(1920, year + 1, size)
+        else:
+            values = codes[rng.choice(len(codes), size, p=probabilities)]
+            is_rare = rng.random(size) < rare
+            if is_rare.any():
+                # values which occur only once, to be rounded, coarsened or merged by k-anonymity
+                tail = np.arange(n_rare[0], n_rare[0] + is_rare.sum())
+                n_rare[0] += len(tail)
+                if values.dtype.kind in 'US':
+                    values = values.astype(object)
+                    values[is_rare] = np.char.add("Z", tail.astype(str))
+                else:
+                    values[is_rare] = codes.max() + 1 + tail
+        if missing > 0:
+            values = values.astype(object)
+            values[rng.random(size) < missing] = None
+        return values
+
+    return generate
+
+
+def generate_table(cnxn: sqlite3.Connection, table_name: str, statement: str, columns: list, n_rows: int,
+                   n_persons: int, person_table: bool, id_columns: dict, pools: dict, generators: dict,
+                   rng: np.random.Generator, chunk_size: int = CHUNK_SIZE):
+    """
+    Creates a table and fills it chunk by chunk with generated rows.
+
+    Parameters:
+        cnxn (sqlite3.Connection): The connection to the test database
+        table_name (str): The name of the table in the database
+        statement (str): The create statement of the table
+        columns (list): The (column, sql type) of every column
+        n_rows (int): The number of rows
+        n_persons (int): The number of insured persons
+        person_table (bool): Whether the table has one row per person, in the order of the persons
+        id_columns (dict): The pool of every id column and whether its ids are stored as text
+        pools (dict): The id population of every pool, the person pools map the number of a person to its id
+        generators (dict): The value generator of every other column
+        rng (numpy.random.Generator): The random number generator
+        chunk_size (int): The number of rows generated and inserted at once
+    """
+    cnxn.execute(f"DROP TABLE IF EXISTS {table_name}")
+    cnxn.execute(statement)
+    insert_query = f"INSERT INTO {table_name} VALUES ({', '.join(['?'] * len(columns))})"
+    for start in range(0, n_rows, chunk_size):
+        size = min(chunk_size, n_rows - start)
+        # all person ids of a row, e.g. PSID and VSID, belong to the same person
+        persons = np.arange(start, start + size) if person_table else rng.integers(0, n_persons, size)
+        values = []
+        for column, _ in columns:
+            if column in generators:
+                values.append(generators[column](size))
+                continue
+            key, as_text = id_columns[column]
+            ids = pools[key][persons] if key in PERSON_POOLS else pools[key][rng.integers(0, len(pools[key]), size)]
+            values.append(ids.astype(str) if as_text else ids)
+        cnxn.executemany(insert_query, zip(*[column_values.tolist() for column_values in values]))
+    cnxn.commit()
+
+
+def generate_test_data(output: Path, data_model: int, year: int, persons: int, rows: dict | None = None,
+                       cardinality: int = 200, skew: float = 1.1, rare: float = 0.001, missing: float = 0.05,
+                       seed: int | None = None, chunk_size: int = CHUNK_SIZE) -> dict:
+    """
+    Generates a synthetic test database of a data model and year in the structure of the original data.
+
+    Parameters:
+        output (Path): The sqlite database file, existing tables of the year are replaced
+        data_model (int): The data model, 2 for DM1/2 or 3 for DM3
+        year (int): The year of the data
+        persons (int): The number of insured persons
+        rows (dict | None): The number of rows of single tables, e.g. {"AMBLEIST": 10_000_000}
+        cardinality (int): The number of frequent distinct values of categorical and code columns
+        skew (float): The exponent of the zipf distribution of the frequent values
+        rare (float): The fraction of rows with a value of their own
+        missing (float): The fraction of rows without value in every column which is neither an id nor a constant
+        seed (int | None): The seed of the random number generator
+        chunk_size (int): The number of rows generated and inserted at once
+
+    Returns:
+        n_rows (dict): The number of rows of every generated table
+    """
+    rng = np.random.default_rng(seed)
+    registry = get_schema()
+    data_types = registry.get_data_types(data_model)
+    constant_variables = set(get_constant_variables(data_model=data_model))
+    output.parent.mkdir(parents=True, exist_ok=True)
+    cnxn = sqlite3.connect(output)
+    cnxn.execute("PRAGMA synchronous = OFF")
+    cnxn.execute("PRAGMA journal_mode = MEMORY")
+
+    # the id pools are shared by all tables, the person pools have one id per person
+    person_ids = rng.permutation(persons) + 10 ** 8
+    pools = {"PSID": person_ids, "VSID": (person_ids * 7919) % 10 ** 9}
+    n_rows = {}
+    for table_name, (statement, columns) in get_table_definitions(data_model, year).items():
+        table = table_name[table_name.find(str(year)) + 4:]
+        person_table = table in PERSON_TABLES
+        n_rows[table_name] = persons if person_table else \
+            (rows or {}).get(table, int(persons * ROWS_PER_PERSON[data_model].get(table, 1)))
+        id_columns, generators = {}, {}
+        for column, sql_type in columns:
+            data_type = 'constant' if column in constant_variables else data_types.get(column)
+            if data_type == 'pseudo':
+                key = column[column.find("_") + 1:] if data_model == 2 \
+                    else registry.get_method(data_model, column)[1] or column
+                if key not in pools:
+                    # case ids are about as many as persons, providers a lot less
+                    pools[key] = rng.permutation(max(persons // (1 if "FALL" in key else 20), 10)) + 10 ** 8
+                id_columns[column] = (key, sql_type.upper() in ("TEXT", "VARCHAR", "VARCHAR2"))
+            else:
+                generators[column] = make_column_generator(
+                    column, sql_type, data_type or ('float' if sql_type.upper() == 'REAL' else 'category'), year,
+                    data_model, rng, cardinality, skew, rare, missing if data_type != 'constant' else 0)
+        begin = datetime.now()
+        generate_table(cnxn, table_name, statement, columns, n_rows[table_name], persons, person_table, id_columns,
+                       pools, generators, rng, chunk_size)
+        print(f"Generating {n_rows[table_name]} rows of {table_name} took {datetime.now() - begin}.")
+    cnxn.close()
+    return n_rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Script to generate synthetic test databases for DM1/2 and DM3")
+    parser.add_argument("--data_model", default=2, type=int, choices=[2, 3], help="Data model, default: 2")
+    parser.add_argument("--year", default=None, type=int, help="Year of the data, default: 2016 for DM1/2, "
+                                                               "2019 for DM3")
+    parser.add_argument("--output", default=None, type=Path,
+                        help="SQLite database file, default: test_data/fdz_generated_data_dm12.db for DM1/2, "
+                             "test_data/fdz_generated_data_dm3.db for DM3")
+    parser.add_argument("--persons", default=1000, type=int, help="Number of insured persons, default: 1000")
+    parser.add_argument("--rows", default=[], nargs='*', metavar="TABLE=N",
+                        help="Number of rows of single tables, e.g. AMBLEIST=10000000")
+    parser.add_argument("--cardinality", default=200, type=int,
+                        help="Number of frequent distinct values of categorical and code columns, default: 200")
+    parser.add_argument("--skew", default=1.1, type=float,
+                        help="Exponent of the zipf distribution of the frequent values, default: 1.1")
+    parser.add_argument("--rare", default=0.001, type=float,
+                        help="Fraction of rows with values occurring only once, default: 0.001")
+    parser.add_argument("--missing", default=0.05, type=float, help="Fraction of missing values, default: 0.05")
+    parser.add_argument("--seed", default=None, type=int, help="Seed of the random number generator, default: None")
+    parser.add_argument("--chunk_size", default=CHUNK_SIZE, type=int,
+                        help=f"Number of rows generated and inserted at once, default: {CHUNK_SIZE}")
+    args = parser.parse_args()
+
+    year = args.year or (2016 if args.data_model == 2 else DM3_TEMPLATE_YEAR)
+    output = args.output or Path("test_data") / f"fdz_generated_data_dm{12 if args.data_model == 2 else 3}.db"
+    if output.resolve() == Path(DM3_TEMPLATE).resolve():
+        parser.error(f"{DM3_TEMPLATE} is the checked-in test data and the template of DM3, choose another --output")
+    begin = datetime.now()
+    generate_test_data(output, args.data_model, year, args.persons,
+                       rows={table: int(n) for table, n in (row.split("=") for row in args.rows)},
+                       cardinality=args.cardinality, skew=args.skew, rare=args.rare, missing=args.missing,
+                       seed=args.seed, chunk_size=args.chunk_size)
+    print(f"The whole process took {datetime.now() - begin}.")
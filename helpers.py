@@ -1,7 +1,38 @@
+import os
+import sys
 import pyodbc
 import sqlite3
+import threading
+from contextlib import contextmanager
+from types import MappingProxyType
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
 import pandas as pd
 
+from schema import get_schema
+
+FETCH_SIZE = 100_000
+# shared memory blocks attached by this process, kept open for the lifetime of the process
+_ATTACHED_BLOCKS = {}
+# database sessions of this process, created by several threads of the pipeline
+_SESSIONS = {}
+_SESSIONS_LOCK = threading.Lock()
+# a forked worker process must not inherit the lock held by another thread of its parent
+os.register_at_fork(after_in_child=lambda: globals().update(_SESSIONS_LOCK=threading.Lock()))
+# data types read into the same buffer as integers or categories
+INTEGER_BUFFER_TYPES = ("integer", "date", "year")
+CATEGORY_BUFFER_TYPES = ("category", "alphanumeric")
+# environment variable with the SQLite file to use instead of the checked-in test data, inherited by worker processes
+SQLITE_FILE_VARIABLE = "PUF_SQLITE_FILE"
+
+
+def get_sqlite_file(data_model: int = 2) -> str:
+    """Return the SQLite file of a data model, or the file set in the environment variable PUF_SQLITE_FILE,
+    e.g. a database generated by generate_test_data.py."""
+    return os.environ.get(SQLITE_FILE_VARIABLE) or ("dm3_testdaten.sqlite" if data_model == 3
+                                                    else "test_data/fdz_generated_data_dm12.db")
+
 
 def connect_to_database(dsn: str, username: str, password: str, data_model: int=2) \
     -> tuple[pyodbc.Connection | sqlite3.Connection, pyodbc.Cursor | sqlite3.Cursor]:
@@ -15,10 +46,10 @@ def connect_to_database(dsn: str, username: str, password: str, data_model: int=
             print(f"Warning: {e}")
             return False
     elif dsn == "sqlite":
-        connect_string = "dm3_testdaten.sqlite" if data_model == 3 \
-            else "test_data/fdz_generated_data_dm12.db"
+        connect_string = get_sqlite_file(data_model)
         try:
-            cnxn: sqlite3.Connection = sqlite3.connect(connect_string)
+            # the connection is borrowed by one thread at a time, but not always by the thread which opened it
+            cnxn: sqlite3.Connection = sqlite3.connect(connect_string, check_same_thread=False)
             cursor: sqlite3.Cursor = cnxn.cursor()
         except ConnectionError as e:
             print(f"Warning: {e}")
@@ -29,6 +60,311 @@ def connect_to_database(dsn: str, username: str, password: str, data_model: int=
     return cnxn, cursor
 
 
+class DatabaseSession:
+    """
+    Database connections and table metadata of one process.
+
+    Connections are kept open in a pool and reused for all tables and columns, and the column
+    names and the number of rows of every table are queried only once.
+    """
+
+    def __init__(self, dsn: str, username: str, password: str, data_model: int = 2):
+        self.dsn = dsn
+        self.username = username
+        self.password = password
+        self.data_model = data_model
+        self._connections = []
+        self._idle_connections = []
+        # the pool is shared by the threads of the pipeline
+        self._lock = threading.Lock()
+        self._columns = {}
+        self._row_counts = {}
+        self._distinct_counts = {}
+
+    @contextmanager
+    def connect(self):
+        """Borrow a connection of the pool, with a new cursor, and return it to the pool afterwards. Threads never
+        borrow the same connection, a new connection is opened if no connection is idle."""
+        with self._lock:
+            cnxn = self._idle_connections.pop() if self._idle_connections else None
+        if cnxn is None:
+            connection = connect_to_database(dsn=self.dsn, username=self.username, password=self.password,
+                                             data_model=self.data_model)
+            if not connection:
+                sys.exit(f"Could not connect to database {self.dsn}.")
+            cnxn = connection[0]
+            with self._lock:
+                self._connections.append(cnxn)
+        try:
+            yield cnxn, cnxn.cursor()
+        finally:
+            with self._lock:
+                self._idle_connections.append(cnxn)
+
+    @contextmanager
+    def connect_unpooled(self):
+        """Open a connection outside of the pool, with a new cursor, and close it afterwards. Settings made on the
+        connection, e.g. the pragmas of a bulk load, do not apply to any other use of the session."""
+        connection = connect_to_database(dsn=self.dsn, username=self.username, password=self.password,
+                                         data_model=self.data_model)
+        if not connection:
+            sys.exit(f"Could not connect to database {self.dsn}.")
+        cnxn, cursor = connection
+        try:
+            yield cnxn, cursor
+        finally:
+            cnxn.close()
+
+    def get_columns(self, table_name: str) -> list:
+        """
+        Fetches the names of all columns of a table, once per table.
+
+        Parameters:
+            table_name (str): The name of the table in the database
+
+        Returns:
+            columns (list): A list of column names from the specified table
+        """
+        if table_name not in self._columns:
+            with self.connect() as (cnxn, cursor):
+                if self.dsn == "sqlite":
+                    cursor.execute(f"PRAGMA table_info({table_name})")
+                    columns = [row[1] for row in cursor.fetchall()]
+                elif self.dsn == "oracle":
+                    # the query returns no rows, only the description of the columns
+                    cursor.execute(f"SELECT * FROM {table_name} WHERE 1 = 0")
+                    columns = [col[0] for col in cursor.description if col[0] != 'index']
+                else:
+                    sys.exit("SQL dialect not supported. Choose from sqlite or oracle")
+            self._columns[table_name] = columns
+        return self._columns[table_name]
+
+    def count_rows(self, table_name: str) -> int:
+        """Return the number of rows of a table, counted once per table."""
+        if table_name not in self._row_counts:
+            with self.connect() as (cnxn, cursor):
+                cursor.execute(f"SELECT COUNT(*) from {table_name}")
+                self._row_counts[table_name] = cursor.fetchall()[0][0]
+        return self._row_counts[table_name]
+
+    def count_distinct(self, table_name: str, column: str) -> int:
+        """Return the number of distinct values of a column, counted once per column."""
+        if (table_name, column) not in self._distinct_counts:
+            with self.connect() as (cnxn, cursor):
+                cursor.execute(f"SELECT COUNT(DISTINCT {column}) from {table_name}")
+                self._distinct_counts[(table_name, column)] = cursor.fetchall()[0][0]
+        return self._distinct_counts[(table_name, column)]
+
+    def first_value(self, table_name: str, column: str):
+        """Return the value of a column in the first row of a table."""
+        limit = "FETCH FIRST 1 ROWS ONLY" if self.dsn == "oracle" else "LIMIT 1"
+        with self.connect() as (cnxn, cursor):
+            cursor.execute(f"SELECT {column} from {table_name} {limit}")
+            return cursor.fetchall()[0][0]
+
+    def close(self):
+        """Close all connections of the session."""
+        with self._lock:
+            connections, self._connections, self._idle_connections = self._connections, [], []
+        for cnxn in connections:
+            cnxn.close()
+
+
+def get_session(dsn: str, username: str, password: str, data_model: int = 2) -> DatabaseSession:
+    """
+    Returns the database session of the current process, which is created on first use.
+    Worker processes do not reuse the session, and thereby the connections, of their parent process.
+    """
+    key = (os.getpid(), dsn, username, data_model)
+    with _SESSIONS_LOCK:
+        if key not in _SESSIONS:
+            _SESSIONS[key] = DatabaseSession(dsn, username, password, data_model)
+        return _SESSIONS[key]
+
+
+def close_sessions():
+    """Closes the connections of all database sessions of the current process."""
+    with _SESSIONS_LOCK:
+        sessions = list(_SESSIONS.items())
+    for (pid, *_), session in sessions:
+        if pid == os.getpid():
+            session.close()
+
+
+def iter_column_chunks(cursor: pyodbc.Cursor | sqlite3.Cursor, table_name: str, column: str,
+                       fetch_size: int = FETCH_SIZE, ordered: bool = False):
+    """Yield the values of a single column in chunks of at most fetch_size values.
+
+    Parameters:
+        cursor: Cursor of the database connection
+        table_name (str): The name of the table in the database
+        column (str): The name of the column
+        fetch_size (int): Number of rows fetched at once
+        ordered (bool): Whether to fetch the values sorted, so that the order does not depend on the database
+
+    Returns:
+        generator: Lists of column values
+    """
+    cursor.arraysize = fetch_size
+    cursor.execute(f"SELECT {column} from {table_name}" + (f" ORDER BY {column}" if ordered else ""))
+    while rows := cursor.fetchmany(fetch_size):
+        yield [row[0] for row in rows]
+
+
+def read_column(cursor: pyodbc.Cursor | sqlite3.Cursor, table_name: str, column: str, data_type: str,
+                n_rows: int = None, fetch_size: int = FETCH_SIZE, ordered: bool = False) -> pd.Series:
+    """Read a single column in chunks into a preallocated buffer matching its data type.
+
+    Integers, dates and years are stored as int64 values with a mask, floats as float64 and categories and
+    alphanumeric codes as integer codes, so the column is not held as a list of Python tuples.
+
+    Parameters:
+        cursor: Cursor of the database connection
+        table_name (str): The name of the table in the database
+        column (str): The name of the column
+        data_type (str): The type of data, as defined in `data_types.csv`
+        n_rows (int): Number of rows of the table, counted if not given
+        fetch_size (int): Number of rows fetched at once
+        ordered (bool): Whether to fetch the values sorted, so that the order does not depend on the database
+
+    Returns:
+        pandas.Series: The column, as Int64, float64, category or object series
+    """
+    if n_rows is None:
+        cursor.execute(f"SELECT COUNT(*) from {table_name}")
+        n_rows = cursor.fetchall()[0][0]
+    return to_typed_column(iter_column_chunks(cursor, table_name, column, fetch_size, ordered), data_type, n_rows)
+
+
+def read_histogram(cursor: pyodbc.Cursor | sqlite3.Cursor, table_name: str, column: str,
+                   data_type: str) -> tuple[pd.Series, np.ndarray]:
+    """Read the distinct values of a single column and their frequencies, counted in the database.
+    The values are sorted, so that their order does not depend on the database.
+
+    Parameters:
+        cursor: Cursor of the database connection
+        table_name (str): The name of the table in the database
+        column (str): The name of the column
+        data_type (str): The type of data, as defined in `data_types.csv`
+
+    Returns:
+        values (pandas.Series): The distinct values, typed as by read_column
+        counts (numpy.ndarray): The frequency of every distinct value
+    """
+    cursor.execute(f"SELECT {column}, COUNT(*) from {table_name} GROUP BY {column} ORDER BY {column}")
+    rows = cursor.fetchall()
+    values = to_typed_column([[row[0] for row in rows]], data_type, len(rows))
+    return values, np.array([row[1] for row in rows], dtype=np.int64)
+
+
+def to_typed_column(chunks, data_type: str, n_rows: int) -> pd.Series:
+    """Convert the chunks of a column into a preallocated buffer matching its data type.
+
+    Integers, dates (YYYYMMDD) and years are stored as int64 values with a mask, which `clean_data` converts
+    without boxing every value. Alphanumeric codes are stored as categories, which `force_k` uses for them anyway.
+    Months are kept as values, as missing months are written as empty fields.
+
+    Parameters:
+        chunks (iterable): Lists of column values
+        data_type (str): The type of data, as defined in `data_types.csv`
+        n_rows (int): Number of values of all chunks
+
+    Returns:
+        pandas.Series: The column, as Int64, float64, category or object series
+    """
+    if data_type in INTEGER_BUFFER_TYPES:
+        buffer_type = "integer"
+    elif data_type in CATEGORY_BUFFER_TYPES:
+        buffer_type = "category"
+    else:
+        buffer_type = data_type
+
+    if buffer_type == "integer":
+        values, mask = np.zeros(n_rows, dtype=np.int64), np.ones(n_rows, dtype=bool)
+    elif buffer_type == "float":
+        values = np.full(n_rows, np.nan)
+    elif buffer_type == "category":
+        values, categories = np.full(n_rows, -1, dtype=np.int32), {}
+    else:
+        values = np.empty(n_rows, dtype=object)
+
+    start = 0
+    for chunk in chunks:
+        stop = start + len(chunk)
+        if buffer_type == "integer":
+            numbers = pd.to_numeric(pd.Series(chunk), errors='coerce')
+            mask[start:stop] = numbers.isna().to_numpy()
+            values[start:stop] = numbers.fillna(0).to_numpy(dtype=np.int64)
+        elif buffer_type == "float":
+            values[start:stop] = pd.to_numeric(pd.Series(chunk), errors='coerce').to_numpy(dtype=float)
+        elif buffer_type == "category":
+            chunk_codes, chunk_categories = pd.factorize(pd.Series(chunk, dtype=object))
+            lookup = np.array([categories.setdefault(category, len(categories)) for category in chunk_categories]
+                              + [-1], dtype=np.int32)
+            values[start:stop] = lookup[chunk_codes]
+        else:
+            values[start:stop] = chunk
+        start = stop
+
+    if buffer_type == "integer":
+        return pd.Series(pd.arrays.IntegerArray(values[:start], mask[:start]))
+    elif buffer_type == "category":
+        # infer the type of the categories as pd.Series would for the whole column, e.g. floats for integers and None
+        has_missing = bool((values[:start] < 0).any())
+        categories = pd.Index(pd.Series(list(categories) + [None] * has_missing)[:len(categories)])
+        try:
+            # sort the categories like astype('category') does
+            order = categories.argsort()
+        except TypeError:
+            order = np.arange(len(categories))
+        ranks = np.empty(len(categories) + 1, dtype=np.int32)
+        ranks[order] = np.arange(len(categories))
+        ranks[-1] = -1
+        return pd.Series(pd.Categorical.from_codes(ranks[values[:start]], categories=categories[order]))
+    return pd.Series(values[:start])
+
+
+def share_pools(pools: dict) -> tuple[list, dict]:
+    """Place the id pools once in shared memory, so worker processes do not receive a copy of every pool.
+
+    Pools that are aliases of another pool (the same array) refer to the same block.
+
+    Parameters:
+        pools (dict): The fixed-width arrays of pseudonyms per pool name
+
+    Returns:
+        tuple: The shared memory blocks, to be closed and unlinked by the caller, and the descriptors
+        (block name, dtype, length) per pool name, which are passed to the workers
+    """
+    blocks, descriptors, shared = [], {}, {}
+    for key, pool in pools.items():
+        if id(pool) not in shared:
+            block = SharedMemory(create=True, size=max(pool.nbytes, 1))
+            np.ndarray(pool.shape, dtype=pool.dtype, buffer=block.buf)[:] = pool
+            blocks.append(block)
+            shared[id(pool)] = (block.name, pool.dtype.str, len(pool))
+        descriptors[key] = shared[id(pool)]
+    return blocks, descriptors
+
+
+def attach_pools(descriptors: dict) -> dict:
+    """Attach the id pools in shared memory without copying them. Every block is attached once per process.
+
+    Parameters:
+        descriptors (dict): The descriptors per pool name, as returned by `share_pools`
+
+    Returns:
+        dict: Read-only arrays of pseudonyms per pool name
+    """
+    pools = {}
+    for key, (name, dtype, length) in descriptors.items():
+        if name not in _ATTACHED_BLOCKS:
+            _ATTACHED_BLOCKS[name] = SharedMemory(name=name)
+        pools[key] = np.ndarray((length,), dtype=dtype, buffer=_ATTACHED_BLOCKS[name].buf)
+        pools[key].flags.writeable = False
+    return pools
+
+
 def get_constant_variables(data_model=2):
     const = ['SA151_AUSGLEICHSJAHR', 'SA152_AUSGLEICHSJAHR', 'SA153_AUSGLEICHSJAHR', 'SA451_AUSGLEICHSJAHR',
              'SA551_AUSGLEICHSJAHR', 'SA651_AUSGLEICHSJAHR', 'SA751_AUSGLEICHSJAHR', 'SA951_AUSGLEICHSJAHR',
@@ -52,29 +388,28 @@ def get_secondary_pools_dm3():
 
 
 def get_pseudo_variables(data_model=2):
-    pseudos = pd.read_csv("data_types.csv").query('Type == "pseudo" and Datamodel == @data_model').Variable.to_list()
-    return pseudos
+    return list(get_schema().get_pseudo_variables(data_model))
 
 
 def get_data_types(data_model=2):
-    data_types = pd.read_csv("data_types.csv").query('Datamodel == @data_model')
-    return dict(zip(data_types.Variable, data_types.Type))
+    # a read-only view of the registry, it is not copied on every call
+    return MappingProxyType(get_schema().get_data_types(data_model))
+
+
+def get_data_type(variable: str, data_model=2) -> str | None:
+    return get_schema().get_data_type(data_model, variable)
 
 
 def get_pseudo_mapping(data_model=2):
-    data_types = pd.read_csv("data_types.csv").query('Type == "pseudo" and Datamodel == @data_model')
-    d = {}
-    for i, row in data_types.iterrows():
-        d[row.Variable] = row.Table
-    return d
+    return dict(get_schema().get_pseudo_mapping(data_model))
 
 
 def clean_data(column_data, dt):
-    if dt == "category":
+    # every type is kept in a native representation, values are only converted to text when they are spilled
+    if dt == "category" or dt == "string":
         column_data = column_data.astype('category')
     elif dt == "date":
-        column_data = pd.to_datetime(column_data, errors='coerce', format='%Y%m%d').dt.date
-        column_data = column_data.apply(lambda x: x if not pd.isnull(x) else None)
+        column_data = pd.to_datetime(column_data, errors='coerce', format='%Y%m%d')
     elif dt == "year":
         column_data = pd.to_datetime(column_data, format='%Y').dt.year
     elif dt == "integer":
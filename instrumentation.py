@@ -0,0 +1,180 @@
+import os
+import csv
+import json
+import time
+import cProfile
+import tracemalloc
+from pathlib import Path
+from contextlib import contextmanager
+
+from checkpoint import RUN_DIR
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+SPANS_FILE = RUN_DIR / "spans.jsonl"
+REPORT_FILE = RUN_DIR / "report.json"
+REPORT_CSV_FILE = RUN_DIR / "report.csv"
+STAGES = ["fetch", "clean", "shuffle", "k", "pseudo", "spill", "merge", "export", "load"]
+SPAN_FIELDS = ["stage", "year", "table", "column", "rows", "distinct", "wall_seconds", "cpu_seconds",
+               "rows_per_second", "rss_increase", "max_rss", "traced_peak", "pid", "start"]
+PROC_STATM = Path("/proc/self/statm")
+
+
+def current_rss() -> int | None:
+    """Return the resident set size of the current process in bytes, None where it cannot be measured."""
+    try:
+        # the second field is the number of resident pages, only available on Linux
+        return int(PROC_STATM.read_text().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def max_rss() -> int | None:
+    """Return the highest resident set size the current process has reached since it started, in bytes,
+    None where it cannot be measured. It is not reset, every later span reports at least the same value."""
+    if resource is None:
+        return None
+    # ru_maxrss is given in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@contextmanager
+def span(stage: str, year: int, table: str, column: str | None = None, rows: int | None = None,
+         spans_file: Path = SPANS_FILE):
+    """
+    Measures one stage of the processing of a table or column and appends it to the spans of the run.
+    Each span is written with a single write, so that the spans of several processes are not interleaved.
+
+    Parameters:
+        stage (str): The stage, one of STAGES
+        year (int): The year of the data
+        table (str): The name of the table (Satzart)
+        column (str | None): The name of the column, None for stages of the whole table
+        rows (int | None): The number of rows, can also be set on the yielded record
+        spans_file (Path): The file collecting the spans of the run
+
+    Returns:
+        record (dict): The span, rows and distinct values can be set within the context
+    """
+    record = {"stage": stage, "year": year, "table": table, "column": column, "rows": rows, "distinct": None,
+              "pid": os.getpid(), "start": time.time()}
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    rss = current_rss()
+    wall, cpu = time.perf_counter(), time.process_time()
+    yield record
+    record["wall_seconds"] = time.perf_counter() - wall
+    record["cpu_seconds"] = time.process_time() - cpu
+    record["rows_per_second"] = record["rows"] / record["wall_seconds"] \
+        if record["rows"] and record["wall_seconds"] > 0 else None
+    # the memory the span keeps at its end, the peak within the span is only known with --profile tracemalloc
+    end_rss = current_rss()
+    record["rss_increase"] = end_rss - rss if rss is not None and end_rss is not None else None
+    record["max_rss"] = max_rss()
+    record["traced_peak"] = tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else None
+    spans_file.parent.mkdir(parents=True, exist_ok=True)
+    with spans_file.open("a") as f:
+        f.write(json.dumps(record) + "\n")
+    # one print per span, so that the lines of several processes are not mixed
+    rate = f" ({record['rows_per_second']:.0f} rows/s)" if record["rows_per_second"] is not None else ""
+    print(f"{stage} of {column + ' in ' if column else ''}{table} {year} took {record['wall_seconds']:.2f} s, "
+          f"{record['cpu_seconds']:.2f} s CPU, {record['rows']} rows{rate}", flush=True)
+
+
+@contextmanager
+def profile_column(mode: str | None, profile_file: Path):
+    """
+    Profiles the processing of a column.
+
+    Parameters:
+        mode (str | None): 'cprofile' to write the statistics of cProfile to profile_file, 'tracemalloc' to record
+            the peak of the traced memory in every span, or None
+        profile_file (Path): The file of the cProfile statistics
+    """
+    if mode == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profile_file.parent.mkdir(parents=True, exist_ok=True)
+            profiler.dump_stats(profile_file)
+    elif mode == "tracemalloc":
+        tracemalloc.start()
+        try:
+            yield
+        finally:
+            tracemalloc.stop()
+    else:
+        yield
+
+
+def clear_spans(spans_file: Path = SPANS_FILE):
+    """Forget the spans of an earlier run."""
+    spans_file.unlink(missing_ok=True)
+
+
+def read_spans(spans_file: Path = SPANS_FILE) -> list:
+    """Return the spans of the run, in the order they were finished."""
+    if not spans_file.exists():
+        return []
+    with spans_file.open("r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summarize_spans(spans: list) -> dict:
+    """
+    Sums up the spans of every stage.
+
+    Parameters:
+        spans (list): The spans of the run
+
+    Returns:
+        stages (dict): The number of spans, wall time, CPU time, rows, rows per second, the largest increase of
+        the RSS of a span and the highest RSS of the processes of every stage
+    """
+    stages = {}
+    for stage in STAGES + sorted({s["stage"] for s in spans} - set(STAGES)):
+        stage_spans = [s for s in spans if s["stage"] == stage]
+        if not stage_spans:
+            continue
+        wall = sum(s["wall_seconds"] for s in stage_spans)
+        rows = sum(s["rows"] or 0 for s in stage_spans)
+        stages[stage] = {"spans": len(stage_spans), "wall_seconds": wall,
+                         "cpu_seconds": sum(s["cpu_seconds"] for s in stage_spans), "rows": rows,
+                         "rows_per_second": rows / wall if wall > 0 else None,
+                         "rss_increase": max((s["rss_increase"] for s in stage_spans
+                                              if s["rss_increase"] is not None), default=None),
+                         "max_rss": max((s["max_rss"] for s in stage_spans if s["max_rss"] is not None),
+                                        default=None)}
+    return stages
+
+
+def write_report(run: dict, spans_file: Path = SPANS_FILE, report_file: Path = REPORT_FILE,
+                 report_csv_file: Path = REPORT_CSV_FILE) -> dict:
+    """
+    Writes the spans of the run into a json report, together with the parameters of the run and a summary of every
+    stage, and into a csv file with one row per span.
+
+    Parameters:
+        run (dict): The parameters and the duration of the run
+        spans_file (Path): The file collecting the spans of the run
+        report_file (Path): The json report
+        report_csv_file (Path): The csv file of the spans
+
+    Returns:
+        report (dict): The report
+    """
+    spans = read_spans(spans_file)
+    report = {"run": run, "stages": summarize_spans(spans), "spans": spans}
+    report_file.parent.mkdir(parents=True, exist_ok=True)
+    report_file.write_text(json.dumps(report, indent=2))
+    with report_csv_file.open("w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=SPAN_FIELDS)
+        writer.writeheader()
+        writer.writerows(spans)
+    return report
@@ -0,0 +1,143 @@
+import json
+import queue
+from pathlib import Path
+from typing import NamedTuple
+
+CALIBRATION_FILE = Path("calibration.json")
+# estimated peak memory per row while a column is fetched, cleaned, shuffled and spilled, by data type
+BYTES_PER_ROW = {'constant': 80, 'pseudo': 120, 'category': 150, 'integer': 150, 'year': 150, 'month': 150,
+                 'float': 150, 'alphanumeric': 250, 'string': 200, 'date': 200}
+# estimated memory per distinct value for the histogram and the k-anonymity mapping
+BYTES_PER_DISTINCT = 200
+# estimated processing time per row by data type, replaced by the calibrated times of earlier runs
+SECONDS_PER_ROW = {'constant': 1e-7, 'pseudo': 5e-7, 'category': 2e-6, 'integer': 2e-6, 'year': 2e-6,
+                   'month': 2e-6, 'float': 3e-6, 'alphanumeric': 4e-6, 'string': 4e-6, 'date': 8e-6}
+# weight of a new measurement in the calibrated time per row
+CALIBRATION_WEIGHT = 0.3
+
+
+class ColumnEstimate(NamedTuple):
+    table: str
+    column: str
+    data_type: str
+    rows: int
+    distinct: int | None
+    memory: int
+    seconds: float
+
+
+def load_calibration(calibration_file: Path = CALIBRATION_FILE) -> dict:
+    """Return the calibrated processing time per row of every data type, the defaults where none was measured."""
+    calibration = dict(SECONDS_PER_ROW)
+    if calibration_file.exists():
+        calibration.update(json.loads(calibration_file.read_text()))
+    return calibration
+
+
+def save_calibration(calibration: dict, calibration_file: Path = CALIBRATION_FILE):
+    calibration_file.write_text(json.dumps(calibration, indent=2, sort_keys=True))
+
+
+def calibrate(calibration: dict, estimate: ColumnEstimate, seconds: float):
+    """
+    Moves the time per row of the data type of a column towards its measured processing time.
+
+    Parameters:
+        calibration (dict): The time per row of every data type, updated in place
+        estimate (ColumnEstimate): The estimate of the processed column
+        seconds (float): The measured processing time of the column
+    """
+    if estimate.rows > 0:
+        per_row = seconds / estimate.rows
+        calibration[estimate.data_type] = ((1 - CALIBRATION_WEIGHT) * calibration[estimate.data_type]
+                                           + CALIBRATION_WEIGHT * per_row)
+
+
+def estimate_column(table: str, column: str, data_type: str, rows: int, distinct: int | None,
+                    calibration: dict, memory_limit: int | None = None) -> ColumnEstimate:
+    """
+    Estimates peak memory and processing time of a column.
+
+    Parameters:
+        table (str): The name of the table (Satzart)
+        column (str): The name of the column
+        data_type (str): The type of data as defined in `data_types.csv`, or 'constant'
+        rows (int): The number of rows of the table
+        distinct (int | None): The number of distinct values of the column, if counted
+        calibration (dict): The time per row of every data type
+        memory_limit (int | None): The bucket size in bytes if columns are shuffled out of core
+
+    Returns:
+        estimate (ColumnEstimate): The estimate of the column
+    """
+    data_type = data_type if data_type in BYTES_PER_ROW else 'string'
+    memory = rows * BYTES_PER_ROW[data_type]
+    if memory_limit is not None and data_type not in ('constant', 'pseudo'):
+        # only one bucket and its shuffled copy are in memory at the same time
+        memory = min(memory, 2 * memory_limit)
+    memory += (distinct or 0) * BYTES_PER_DISTINCT
+    return ColumnEstimate(table, column, data_type, rows, distinct, memory, rows * calibration[data_type])
+
+
+def print_plan(estimates: list, num_processes: int, memory_budget: int | None = None):
+    """
+    Prints the estimated peak memory and processing time of every table and its most expensive columns.
+
+    Parameters:
+        estimates (list): The estimates of all columns
+        num_processes (int): The number of processes the columns are distributed to
+        memory_budget (int | None): The memory budget in bytes
+    """
+    tables = {}
+    for estimate in estimates:
+        tables.setdefault(estimate.table, []).append(estimate)
+    print(f"{'table':<12}{'rows':>12}{'columns':>9}{'peak MB':>10}{'seconds':>10}  most expensive column")
+    for table, columns in sorted(tables.items(), key=lambda item: -sum(e.seconds for e in item[1])):
+        largest = max(columns, key=lambda e: e.seconds)
+        print(f"{table:<12}{columns[0].rows:>12}{len(columns):>9}{max(e.memory for e in columns) / 1024 ** 2:>10.1f}"
+              f"{sum(e.seconds for e in columns):>10.2f}  {largest.column} ({largest.data_type})")
+    total_seconds = sum(e.seconds for e in estimates)
+    peak = sum(sorted((e.memory for e in estimates), reverse=True)[:num_processes])
+    print(f"{len(estimates)} columns, {total_seconds:.1f} s of work, about {total_seconds / num_processes:.1f} s "
+          f"with {num_processes} processes, peak memory up to {peak / 1024 ** 2:.1f} MB"
+          + (f" of a budget of {memory_budget / 1024 ** 2:.0f} MB." if memory_budget is not None else "."))
+    too_large = [e for e in estimates if memory_budget is not None and e.memory > memory_budget]
+    for e in too_large:
+        print(f"Warning: {e.table}.{e.column} is estimated to need {e.memory / 1024 ** 2:.1f} MB alone, "
+              f"it is run without any other column.")
+
+
+def run_admitted(pool, func, tasks: list, estimates: list, memory_budget: int | None = None):
+    """
+    Runs the tasks in the process pool in their order, but admits a task only while the estimated memory of all
+    admitted tasks stays within the budget. If the next task does not fit, smaller later tasks are admitted first.
+    A task exceeding the budget on its own is run alone.
+
+    Parameters:
+        pool (multiprocessing.Pool): The process pool
+        func (callable): The function applied to every task
+        tasks (list): The arguments of func for every task
+        estimates (list): The estimate of every task
+        memory_budget (int | None): The memory budget in bytes, all tasks are admitted at once if None
+
+    Returns:
+        generator: The results of func in the order of completion
+    """
+    finished = queue.Queue()
+    pending = list(range(len(tasks)))
+    admitted = {}
+    while pending or admitted:
+        for i in list(pending):
+            memory = sum(admitted.values())
+            if admitted and memory_budget is not None and memory + estimates[i].memory > memory_budget:
+                continue
+            pending.remove(i)
+            admitted[i] = estimates[i].memory
+            pool.apply_async(func, (tasks[i],),
+                             callback=lambda result, i=i: finished.put((i, result, None)),
+                             error_callback=lambda error, i=i: finished.put((i, None, error)))
+        i, result, error = finished.get()
+        if error is not None:
+            raise error
+        del admitted[i]
+        yield result
@@ -1,18 +1,10 @@
+import argparse
 import unittest
 import sys
 import pandas as pd
-from helpers import connect_to_database
-
-
-def get_prefix(table: str) -> str:
-    """
-    Returns the correct table prefix for the specified "Satzart" as available in the database
-    Parameters:
-        table (str): The name of the current table (Satzart)
-    Returns:
-        prefix (str): Prefix of the table
-    """
-    return "V" if table == 'SA131' else "VBJ"
+from helpers import connect_to_database, close_sessions
+from generate_puf import get_prefix, get_tables, get_data_model_from_year
+from verification import verify
 
 
 class TestOutputData(unittest.TestCase):
@@ -20,18 +12,18 @@ class TestOutputData(unittest.TestCase):
     USERNAME = "fdz"
     PWD = "fdz"
     YEAR = 2016
-    DATA_MODEL = 2 if YEAR <= 2018 else 3
-    ALL_TABLES = ["SA151", "SA152", "SA153", "SA451", "SA551", "SA651", "SA751", "SA951", "SA131"] if (
-                 DATA_MODEL == 2) else ["VERS", "VERSQ", "VERSQDMP", "REZ", "AMBFALL", "KHFALL", "ZAHNFALL",
-                      "AMBDIAG", "AMBOPS", "AMBLEIST", "KHFA", "KHENTG", "KHDIAG", "KHPROZ",
-                      "ZAHNLEIST", "ZAHNBEF", "EZD", "VS"]
+
+    @classmethod
+    def setUpClass(cls):
+        cls.DATA_MODEL = get_data_model_from_year(cls.YEAR)
+        cls.ALL_TABLES = get_tables(cls.DATA_MODEL)[0]
 
     def test_same_datatypes(self):
         print("\nTest whether the Public Use File contains the same datatypes as the original data.")
         con, cursor = connect_to_database(self.DSN, self.USERNAME, self.PWD, self.DATA_MODEL)
         for table in self.ALL_TABLES:
             print(f"\nTable {table}")
-            prefix = get_prefix(table)
+            prefix = get_prefix(table, self.DATA_MODEL)
             table_name_puf = f"{prefix}{self.YEAR}{table}_puf"
             table_name_original = f"{prefix}{self.YEAR}{table}"
             df_original = pd.read_sql_query(f"PRAGMA table_info({table_name_original})", con=con)
@@ -49,7 +41,7 @@ class TestOutputData(unittest.TestCase):
         con, cursor = connect_to_database(self.DSN, self.USERNAME, self.PWD, self.DATA_MODEL)
         for table in self.ALL_TABLES:
             print(f"Table {table}")
-            prefix = get_prefix(table)
+            prefix = get_prefix(table, self.DATA_MODEL)
             table_name_puf = f"{prefix}{self.YEAR}{table}_puf"
             table_name_original = f"{prefix}{self.YEAR}{table}"
 
@@ -75,9 +67,22 @@ class TestOutputData(unittest.TestCase):
             self.assertEqual(n_rows_original, n_rows_puf)
         con.close()
 
+    def test_verification(self):
+        print("Test in the database that every column fulfills k-anonymity, changes no more rows than k-anonymity "
+              "requires and uses no more pseudonyms than its id pool.")
+        args = argparse.Namespace(dsn=self.DSN, username=self.USERNAME, password=self.PWD, year=self.YEAR,
+                                  years=None, k=3, sample_fraction=None)
+        results = verify(args, num_processes=4)
+        close_sessions()
+        failed = [r for r in results if r.check in ("k", "histogram", "pool") and not r.passed]
+        for r in failed:
+            print(f"{r.table}.{r.column}: {r.check} check failed with {r.value}, expected {r.expected}")
+        self.assertTrue(results)
+        self.assertEqual(failed, [])
+
 
 if __name__ == '__main__':
     if len(sys.argv) > 1:
-        TestOutputData.YEAR = sys.argv.pop()
+        TestOutputData.YEAR = int(sys.argv.pop())
     unittest.main()
     # unittest.main(argv=['', '-v'])
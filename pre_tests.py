@@ -1,7 +1,32 @@
+import argparse
+import csv
+import gzip
+import os
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
+import warnings
+from datetime import date
+from multiprocessing.pool import ThreadPool
+from pathlib import Path
+from unittest import mock
+
 import pandas as pd
-from helpers import connect_to_database
-from functions import force_k, shuffle_column
+from helpers import (connect_to_database, get_session, read_column, read_histogram, clean_data, share_pools,
+                     attach_pools, DatabaseSession, SQLITE_FILE_VARIABLE)
+from functions import (force_k, force_k_from_histogram, shuffle_column, external_shuffle, generate_pseudonyms,
+                       sample_from_pool, draw_sample)
+from storage import pa, pq, spill_column, merge_spilled_columns, export_spilled_columns, to_csv_text
+from schema import load_schema
+from generate_puf import plan_column_tasks, estimate_tasks, generate_pool_of_ids
+from checkpoint import RunManifest
+from generate_test_data import generate_test_data
+from planner import estimate_column, run_admitted, SECONDS_PER_ROW
+from instrumentation import span, write_report, current_rss
+from verification import normalized
+from randomness import KeyedStream, load_or_generate_run_key, BLOCK_SIZE
 
 
 class TestDatabase(unittest.TestCase):
@@ -10,6 +35,127 @@ class TestDatabase(unittest.TestCase):
         # test sqlite connection for local testing purposes
         self.assertIsNot(connect_to_database("sqlite", 'fdz', 'fdz'), False)
 
+    def test_session(self):
+        # test that the session reuses its connections and queries the table metadata only once
+        session = get_session("sqlite", 'fdz', 'fdz', data_model=3)
+        self.assertIs(get_session("sqlite", 'fdz', 'fdz', data_model=3), session)
+        try:
+            with session.connect() as (cnxn, cursor):
+                cursor.execute("SELECT COUNT(*) from BJ2019VERS")
+                n_rows = cursor.fetchall()[0][0]
+            columns = session.get_columns("BJ2019VERS")
+            self.assertEqual(session.count_rows("BJ2019VERS"), n_rows)
+            self.assertIs(session.get_columns("BJ2019VERS"), columns)
+            self.assertEqual(len(session._connections), 1)
+            # settings of an unpooled connection do not apply to the pooled connections
+            with session.connect_unpooled() as (cnxn, cursor):
+                cursor.execute("PRAGMA synchronous = OFF")
+            with session.connect() as (cnxn, cursor):
+                self.assertNotEqual(cursor.execute("PRAGMA synchronous").fetchone()[0], 0)
+            self.assertEqual(len(session._connections), 1)
+        finally:
+            session.close()
+
+    def test_session_threads(self):
+        # test that the prefetch and writer threads of a table worker can borrow connections opened by another thread
+        session = get_session("sqlite", 'fdz', 'fdz', data_model=3)
+        try:
+            n_rows = session.count_rows("BJ2019VERS")
+            with ThreadPool(1) as pool:
+                self.assertEqual(pool.apply(session.first_value, ("BJ2019VERS", "COUNT(*)")), n_rows)
+            self.assertEqual(len(session._connections), 1)
+            # threads that borrow at the same time never share a connection
+            barrier = threading.Barrier(4)
+
+            def borrow(_):
+                with session.connect() as (cnxn, cursor):
+                    barrier.wait(timeout=10)
+                    return id(cnxn)
+
+            with ThreadPool(4) as pool:
+                self.assertEqual(len(set(pool.map(borrow, range(4)))), 4)
+            self.assertEqual(len(session._connections), 4)
+            self.assertEqual(len(session._idle_connections), 4)
+        finally:
+            session.close()
+
+    def test_column_tasks(self):
+        # test that every column of the tables is scheduled once and the planner estimates the largest table highest
+        args = argparse.Namespace(dsn="sqlite", username='fdz', password='fdz', year=2019, sample_fraction=None,
+                                  memory_limit=None)
+        session = get_session("sqlite", 'fdz', 'fdz', data_model=3)
+        try:
+            tasks, table_columns = plan_column_tasks(["EZD", "ZAHNBEF"], {}, args, session)
+            estimates = estimate_tasks(tasks, SECONDS_PER_ROW)
+        finally:
+            session.close()
+        self.assertEqual([(table, e, col) for table, e, col, _, _ in tasks],
+                         [(table, e, col) for table, columns in table_columns.items()
+                          for e, col in enumerate(columns)])
+        self.assertEqual(max(estimates, key=lambda estimate: estimate.seconds).table, "BJ2019ZAHNBEF")
+
+    def test_empty_id_pool(self):
+        # test that a pseudo column without any id, e.g. in a small sample, still gets pseudonyms
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                mock.patch.dict(os.environ, {SQLITE_FILE_VARIABLE: str(Path(tmp_dir) / "ids.db")}):
+            cnxn = sqlite3.connect(Path(tmp_dir) / "ids.db")
+            cnxn.execute("CREATE TABLE BJ2019KHFALL (KHPSEUDO TEXT)")
+            cnxn.executemany("INSERT INTO BJ2019KHFALL VALUES (?)", [(None,)] * 5)
+            cnxn.commit()
+            cnxn.close()
+            session = DatabaseSession("sqlite", 'fdz', 'fdz', data_model=3)
+            try:
+                pool = generate_pool_of_ids("KHPSEUDO", "KHFALL", 2019, 3, session)
+            finally:
+                session.close()
+        self.assertEqual(len(pool), 1)
+        self.assertEqual(list(sample_from_pool(pool, 5)), [pool[0]] * 5)
+        self.assertEqual(len(sample_from_pool(generate_pseudonyms(0), 0)), 0)
+
+    def test_read_column(self):
+        # test that columns read in chunks equal the fetched rows
+        cnxn = sqlite3.connect(":memory:")
+        cursor = cnxn.cursor()
+        cursor.execute("CREATE TABLE T (CAT INTEGER, NUM INTEGER, TXT TEXT, DAT INTEGER, JAHR INTEGER)")
+        rows = [(1, 5, 'a', 20190101, 1950), (None, None, None, None, None), (2, 7, 'b', 99991231, 1960),
+                (1, 5, 'a', 20190231, 1950), (3, None, 'c', 20191231, 2019)]
+        cursor.executemany("INSERT INTO T VALUES (?, ?, ?, ?, ?)", rows)
+        for e, (col, data_type) in enumerate([('CAT', 'category'), ('NUM', 'integer'), ('TXT', 'alphanumeric'),
+                                              ('DAT', 'date'), ('JAHR', 'year')]):
+            data = read_column(cursor, "T", col, data_type, fetch_size=2)
+            expected = clean_data(pd.Series([row[e] for row in rows]), data_type)
+            # force_k processes alphanumeric codes as categories
+            expected_values = expected.astype('category') if data_type == 'alphanumeric' else expected
+            self.assertEqual(clean_data(data, data_type).astype(str).tolist(), expected_values.astype(str).tolist())
+            self.assertEqual(to_csv_text(force_k(clean_data(data, data_type), data_type, 2), data_type).tolist(),
+                             to_csv_text(force_k(expected, data_type, 2), data_type).tolist())
+        self.assertEqual(list(read_column(cursor, "T", "CAT", "category").cat.categories), [1.0, 2.0, 3.0])
+        # dates and years are read without boxing every value, alphanumeric codes as categories
+        for col, data_type in [('NUM', 'integer'), ('DAT', 'date'), ('JAHR', 'year')]:
+            self.assertEqual(str(read_column(cursor, "T", col, data_type).dtype), "Int64")
+        self.assertEqual(str(read_column(cursor, "T", "TXT", "alphanumeric").dtype), "category")
+        cnxn.close()
+
+    def test_generated_test_data(self):
+        # test that the generated DM3 database has all tables, one row per person in VERS and consistent person ids
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output = Path(tmp_dir) / "dm3.db"
+            n_rows = generate_test_data(output, 3, 2020, persons=200, rows={"AMBLEIST": 1500}, missing=0.2,
+                                        seed=1, chunk_size=400)
+            cnxn = sqlite3.connect(output)
+            template = sqlite3.connect("dm3_testdaten.sqlite")
+            self.assertEqual(len(n_rows), template.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' "
+                                                           "AND name LIKE 'BJ2019%' AND name NOT LIKE '%_puf'")
+                             .fetchone()[0])
+            template.close()
+            self.assertEqual(cnxn.execute("SELECT COUNT(DISTINCT PSID) FROM BJ2020VERS").fetchone()[0], 200)
+            self.assertEqual(cnxn.execute("SELECT COUNT(*) FROM BJ2020AMBLEIST").fetchone()[0], 1500)
+            self.assertEqual(cnxn.execute("SELECT COUNT(*) FROM BJ2020AMBLEIST a LEFT JOIN BJ2020VERS v "
+                                          "ON a.PSID = v.PSID AND a.VSID = v.VSID WHERE v.PSID IS NULL").fetchone()[0], 0)
+            n_missing = cnxn.execute("SELECT COUNT(*) FROM BJ2020AMBLEIST WHERE GONR IS NULL").fetchone()[0]
+            self.assertTrue(150 < n_missing < 450)
+            cnxn.close()
+
 
 class TestDataProcessing(unittest.TestCase):
 
@@ -40,6 +186,67 @@ class TestDataProcessing(unittest.TestCase):
             number_counts = df['values'].value_counts()
             self.assertTrue(number_counts[number_counts < k].empty)
 
+    def test_local_rounding(self):
+        print("Test local rounding, i.e. rare numbers are rounded to the nearest number fulfilling k")
+        k = 3
+        values = pd.Series([1, 1, 1, 2, 4, 5, 5, 5, 9, None, None, None])
+        k_values = force_k(values, 'float', k)
+        print("before\t\t", list(values))
+        print("afterwards\t", list(k_values), "\n")
+        self.assertEqual(list(k_values[:9]), [1, 1, 1, 1, 5, 5, 5, 5, 5])
+        self.assertTrue(k_values[9:].isna().all())
+
+        rare_nan_values = pd.Series([2, 2, 2, 7, 7, 7, None])
+        self.assertEqual(list(force_k(rare_nan_values, 'float', k)), [2, 2, 2, 7, 7, 7, 2])
+
+        # if neither the values nor the missing values fulfill k, they are merged into one group of missing values
+        self.assertTrue(force_k(pd.Series([5, 6, None, None]), 'float', k).isna().all())
+
+        # a column without any value is processed without concatenating empty entries
+        with warnings.catch_warnings():
+            warnings.simplefilter("error", FutureWarning)
+            self.assertTrue(force_k(pd.Series([None] * 4, dtype=object), 'category', k).isna().all())
+
+    def test_hierarchical_coarsening(self):
+        print("Test hierarchical coarsening, i.e. only rare codes are truncated to the next hierarchy level")
+        k = 3
+        values = pd.Series(['E110'] * 3 + ['E111', 'E112', 'E119'] + ['I10'] * 4 + ['I11', 'I12', 'I13', None])
+        k_values = force_k(values, 'string', k)
+        print("before\t\t", list(values))
+        print("afterwards\t", list(k_values), "\n")
+        self.assertEqual(list(k_values[:13]), ['E110'] * 3 + ['E11'] * 3 + ['I10'] * 4 + ['I1'] * 3)
+        self.assertTrue(pd.isnull(k_values[13]))
+
+        # numeric codes are truncated as text, also if missing values turned them into floats
+        k_values = force_k(pd.Series([1, 1, 1, 2]).astype('category'), 'string', k)
+        self.assertEqual(list(k_values), [''] * 4)
+        k_values = force_k(pd.Series([10115] * 3 + [10117, 10119, 10178, None]).astype('category'), 'string', k)
+        self.assertEqual([text.decode() for text in to_csv_text(k_values, 'string')],
+                         ['10115'] * 3 + ['101'] * 3 + [''])
+
+    def test_other_merging(self):
+        print("Test other merging, i.e. rare categories are merged into 'Other' and the result stays categorical")
+        k = 3
+        # a single rare category also merges the smallest category fulfilling k into 'Other'
+        k_values = force_k(pd.Series(['A'] * 5 + ['B'] * 3 + ['C']), 'category', k)
+        self.assertIsInstance(k_values.dtype, pd.CategoricalDtype)
+        self.assertEqual(list(k_values), ['A'] * 5 + ['Other'] * 4)
+        self.assertEqual(list(k_values.cat.categories), ['A', 'Other'])
+
+        # missing values are a category of their own, which is merged like any other category
+        k_values = force_k(pd.Series(['A'] * 3 + ['B'] * 3 + [None] * 2), 'category', k)
+        self.assertIsInstance(k_values.dtype, pd.CategoricalDtype)
+        self.assertEqual(list(k_values), ['A'] * 3 + ['Other'] * 5)
+        k_values = force_k(pd.Series([None] * 3 + ['A'] * 4), 'category', k)
+        self.assertTrue(k_values[:3].isna().all())
+        self.assertEqual(list(k_values[3:]), ['A'] * 4)
+
+        # numeric categories keep their type next to 'Other'
+        k_values = force_k(pd.Series([1] * 3 + [2] * 3 + [3, 4, 4]), 'category', k)
+        self.assertIsInstance(k_values.dtype, pd.CategoricalDtype)
+        self.assertEqual(list(k_values), [1] * 3 + [2] * 3 + ['Other'] * 3)
+        self.assertEqual(list(k_values.cat.categories), [1, 2, 'Other'])
+
     def test_column_shuffling(self):
         print(f"Test random column shuffling, i.e. assert that the values have a new order.")
         input_values = pd.Series([1, 3, 1, 5, 3, 7, 3, 5, 6, 5])
@@ -49,6 +256,115 @@ class TestDataProcessing(unittest.TestCase):
         self.assertIs(input_values.equals(output_values), False)
         self.assertEqual(set(list(input_values)), set(list(output_values)))
 
+    def test_shuffling_keeps_dtype(self):
+        print("Test that column shuffling keeps the data type of the column")
+        for input_values in [pd.Series(['L', 'R', 'L', None, 'B'], dtype='category'),
+                             pd.Series([2010, None, 2012], dtype='Int64')]:
+            output_values = shuffle_column(input_values)
+            self.assertEqual(output_values.dtype, input_values.dtype)
+            self.assertEqual(sorted(output_values.dropna()), sorted(input_values.dropna()))
+
+    def test_external_shuffling(self):
+        print("Test out of core shuffling, i.e. the buckets contain all values and fulfill k together")
+        k = 3
+        input_values = pd.Series(list(range(50)) * 3 + [100, 101, None], dtype='Int64')
+        chunks = (input_values[start:start + 20] for start in range(0, len(input_values), 20))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            counts, buckets = external_shuffle(chunks, len(input_values), Path(tmp_dir), memory_limit=200)
+            output_values = [force_k(bucket, 'integer', k, counts=counts) for bucket in buckets]
+        self.assertGreater(len(output_values), 1)
+        output_values = pd.concat(output_values, ignore_index=True)
+        self.assertEqual(len(output_values), len(input_values))
+        # the rare values 100 and 101 are rounded to 49, the single missing value to the smallest value 0
+        self.assertEqual(sorted(output_values), sorted(list(range(50)) * 3 + [49, 49, 0]))
+
+    def test_external_shuffling_categories(self):
+        print("Test out of core shuffling of categories, i.e. the buckets stay categorical within the memory limit")
+        chunks = [clean_data(pd.Series(['A', 'B', 'C'] * 1000 + [f'RARE{i}']), 'category') for i in range(20)]
+        memory_limit = 20_000
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            counts, buckets = external_shuffle(iter(chunks), 20 * 3001, Path(tmp_dir), memory_limit=memory_limit)
+            buckets = list(buckets)
+        self.assertGreater(len(buckets), 1)
+        for bucket in buckets:
+            self.assertIsInstance(bucket.dtype, pd.CategoricalDtype)
+            self.assertEqual(len(bucket.cat.categories), 23)
+            self.assertLessEqual(bucket.memory_usage(deep=True, index=False), memory_limit)
+        self.assertEqual(sum(len(bucket) for bucket in buckets), 20 * 3001)
+        self.assertEqual(counts['RARE7'], 1)
+
+    def test_histogram_pushdown(self):
+        print("Test that the column generated from the histogram has the same values as the shuffled column")
+        k = 3
+        cnxn = sqlite3.connect(":memory:")
+        cursor = cnxn.cursor()
+        cursor.execute("CREATE TABLE T (CAT INTEGER, NUM INTEGER, DAT INTEGER, TXT TEXT)")
+        rows = [(1, 5, 20190101, 'A00'), (None, None, None, 'A001'), (2, 7, 20190102, 'B1'), (1, 5, 99991231, 'B1'),
+                (3, None, 20190101, 'B12'), (1, 5, 20190101, 'B1'), (2, 7, None, None), (2, 8, None, 'A00')]
+        cursor.executemany("INSERT INTO T VALUES (?, ?, ?, ?)", rows)
+        for e, (col, data_type) in enumerate([('CAT', 'category'), ('NUM', 'integer'), ('DAT', 'date'),
+                                              ('TXT', 'string')]):
+            expected = force_k(shuffle_column(clean_data(read_column(cursor, "T", col, data_type), data_type)),
+                               data_type, k)
+            values, counts = read_histogram(cursor, "T", col, data_type)
+            self.assertEqual(len(values), len(set(row[e] for row in rows)))
+            output_values = force_k_from_histogram(clean_data(values, data_type), counts, data_type, k)
+            self.assertEqual(output_values.dtype, expected.dtype)
+            self.assertEqual(sorted(to_csv_text(output_values)), sorted(to_csv_text(expected)))
+        cnxn.close()
+
+    def test_typed_columns(self):
+        print("Test that dates and codes are processed in a native representation and written as before")
+        k = 3
+        dates = pd.Series([20190101] * 3 + [20190102, 99991231, None, None, None, 20190105, 20190231] + [20190107] * 3,
+                          dtype=object)
+        cleaned = clean_data(dates, 'date')
+        self.assertEqual(str(cleaned.dtype), 'datetime64[ns]')
+        # dates used to be cleaned into datetime.date objects, with None for missing values
+        boxed = pd.to_datetime(dates, errors='coerce', format='%Y%m%d').dt.date
+        boxed = boxed.apply(lambda x: x if not pd.isnull(x) else None)
+        self.assertEqual(to_csv_text(force_k(cleaned, 'date', k), 'date').tolist(),
+                         to_csv_text(force_k(boxed, 'date', k)).tolist())
+
+        codes = pd.Series(['E110'] * 3 + ['E111', 'E112', 'E119', None, None, None], dtype=object)
+        cleaned = clean_data(codes, 'string')
+        self.assertEqual(str(cleaned.dtype), 'category')
+        self.assertEqual([text.decode() for text in to_csv_text(force_k(cleaned, 'string', k), 'string')],
+                         ['E110'] * 3 + ['E11'] * 3 + [''] * 3)
+
+    def test_sample(self):
+        print("Test that the sample of persons is drawn without replacement in the requested size")
+        sample = draw_sample(10_000, 0.01)
+        self.assertEqual(len(sample), 100)
+        self.assertEqual(len(set(sample)), 100)
+        self.assertTrue(0 <= sample.min() and sample.max() < 10_000)
+        self.assertEqual(len(draw_sample(10, 1)), 10)
+
+    def test_pseudonym_pool(self):
+        print("Test that a pool of pseudonyms contains only unique pseudonyms of the requested length")
+        pool = generate_pseudonyms(2000, length=4)
+        self.assertEqual(len(pool), 2000)
+        self.assertEqual(len(set(pool)), 2000)
+        self.assertTrue(all(len(pseudonym) == 4 and pseudonym.isdigit() for pseudonym in pool))
+        self.assertTrue(all(len(pseudonym) == 19 for pseudonym in generate_pseudonyms(10, variable='PSID')))
+
+    def test_shared_pools(self):
+        print("Test that id pools in shared memory are shared between aliases and sampled from the pool")
+        psid_pool = generate_pseudonyms(100)
+        blocks, descriptors = share_pools({"BSNRPSEUDO": psid_pool, "NBSNRPSEUDO": psid_pool,
+                                           "KHPSEUDO": generate_pseudonyms(5)})
+        try:
+            self.assertEqual(len(blocks), 2)
+            self.assertEqual(descriptors["BSNRPSEUDO"], descriptors["NBSNRPSEUDO"])
+            pools = attach_pools(descriptors)
+            self.assertEqual(list(pools["NBSNRPSEUDO"]), list(psid_pool))
+            sample = sample_from_pool(pools["KHPSEUDO"], 1000)
+            self.assertEqual(set(sample), set(pools["KHPSEUDO"]))
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+
     def test_randomness(self):
         print("Test randomness of column shuffling, i.e we shuffle the same column twice and check that the output is "
               "different")
@@ -60,6 +376,198 @@ class TestDataProcessing(unittest.TestCase):
         print("Output values 2:\t", list(output_values_1))
         self.assertIs(output_values.equals(output_values_1), False)
 
+    def test_keyed_streams(self):
+        print("Test that a run key reproduces every stream, and that the streams of different columns differ")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            run_key = load_or_generate_run_key(Path(tmp_dir) / "run_key")
+            self.assertEqual(load_or_generate_run_key(Path(tmp_dir) / "run_key"), run_key)
+        input_values = pd.Series(range(1000))
+        output_values = shuffle_column(input_values, KeyedStream(run_key, 2019, "VERS", "GEBJAHR", "shuffle"))
+        self.assertTrue(output_values.equals(
+            shuffle_column(input_values, KeyedStream(run_key, 2019, "VERS", "GEBJAHR", "shuffle"))))
+        self.assertFalse(output_values.equals(
+            shuffle_column(input_values, KeyedStream(run_key, 2019, "VERS", "PLZ", "shuffle"))))
+        self.assertEqual(sorted(output_values), list(input_values))
+        # every block of a chunk is derived on its own
+        stream = KeyedStream(run_key, 2019, "VERS", "GEBJAHR", "shuffle")
+        stream.token_bytes(10)
+        self.assertEqual(stream.token_bytes(BLOCK_SIZE + 10), stream.derive(1, 0, BLOCK_SIZE) + stream.derive(1, 1, 10))
+        self.assertEqual(len(set(generate_pseudonyms(1000, stream=stream))), 1000)
+
+
+class TestStorage(unittest.TestCase):
+
+    def test_spill_and_merge(self):
+        print("Test that spilled columns are merged into the same csv rows as csv.writer would write them")
+        columns = {'ICD': pd.Series(['E11', None, 'Ä10'], dtype=object),
+                   'AMOUNT': pd.Series([1.5, float('nan'), 3.0]),
+                   'YEAR': pd.Series([2010, None, 2012], dtype='Int64')}
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_dir = Path(tmp_dir)
+            spill_files = [spill_column(values, tmp_dir / f"{e}_{col}.npy")
+                           for e, (col, values) in enumerate(columns.items())]
+            merge_spilled_columns(spill_files, list(columns), tmp_dir / "merged.csv", chunk_size=2)
+            with (tmp_dir / "expected.csv").open("w", newline="") as f:
+                writer = csv.writer(f, delimiter=",")
+                writer.writerow(list(columns))
+                # missing integers are written as empty fields, like None
+                writer.writerows(zip(*[values.astype(object).where(values.notna(), None) if values.dtype == 'Int64'
+                                       else values for values in columns.values()]))
+            self.assertEqual((tmp_dir / "merged.csv").read_text(), (tmp_dir / "expected.csv").read_text())
+            self.assertEqual((tmp_dir / "merged.csv").read_text().splitlines()[2], ",nan,")
+
+    @unittest.skipIf(pa is None, "pyarrow is not installed")
+    def test_export(self):
+        print("Test that spilled columns are exported typed, with missing values as nulls, in row groups")
+        columns = {'ICD': pd.Series(['E11', None, 'Ä10']).astype('category'),
+                   'AMOUNT': pd.Series([1.5, float('nan'), 3.0]),
+                   'YEAR': pd.Series([2010, None, 2012], dtype='Int64'),
+                   'DATE': pd.to_datetime(pd.Series(['20100101', None, '20121231']), format='%Y%m%d')}
+        data_types = ['category', 'float', 'year', 'date']
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_dir = Path(tmp_dir)
+            spill_files = [spill_column(values, tmp_dir / f"{e}_{col}.npy", data_type)
+                           for e, ((col, values), data_type) in enumerate(zip(columns.items(), data_types))]
+            export_spilled_columns(spill_files, list(columns), data_types, tmp_dir / "export.parquet", "parquet",
+                                   chunk_size=2)
+            merge_spilled_columns(spill_files, list(columns), tmp_dir / "merged.csv")
+            export_spilled_columns(spill_files, list(columns), data_types, tmp_dir / "export.csv.gz", "csv.gz")
+            parquet_file = pq.ParquetFile(tmp_dir / "export.parquet")
+            self.assertEqual(parquet_file.metadata.num_row_groups, 2)
+            self.assertEqual(parquet_file.schema_arrow.types, [pa.string(), pa.float64(), pa.int64(), pa.date32()])
+            self.assertEqual(parquet_file.read().to_pydict(),
+                             {'ICD': ['E11', None, 'Ä10'], 'AMOUNT': [1.5, None, 3.0], 'YEAR': [2010, None, 2012],
+                              'DATE': [date(2010, 1, 1), None, date(2012, 12, 31)]})
+            with gzip.open(tmp_dir / "export.csv.gz", "rb") as f:
+                self.assertEqual(f.read(), (tmp_dir / "merged.csv").read_bytes())
+
+
+class TestSchema(unittest.TestCase):
+
+    def test_precompiled_schema(self):
+        print("Test that the precompiled schema equals the parsed csv files and is compiled again after changes")
+        data_types = pd.read_csv("data_types.csv")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_dir = Path(tmp_dir)
+            data_types.to_csv(tmp_dir / "data_types.csv", index=False)
+            args = (tmp_dir / "schema.pickle", tmp_dir / "data_types.csv", Path("variable_processing.csv"))
+            load_schema(*args)
+            schema = load_schema(*args)
+            for data_model in [2, 3]:
+                expected = data_types.query('Datamodel == @data_model')
+                self.assertEqual(schema.get_data_types(data_model), dict(zip(expected.Variable, expected.Type)))
+                self.assertEqual(schema.get_pseudo_variables(data_model),
+                                 expected.query('Type == "pseudo"').Variable.to_list())
+            self.assertTrue(schema.is_pseudo(3, "PSID"))
+            self.assertEqual(schema.get_method(3, "PSID"), ("Pool", "PSID"))
+            self.assertEqual(schema.get_data_type(3, "GEBJAHR"), "year")
+            self.assertIsNone(schema.get_data_type(3, "UNKNOWN"))
+
+            data_types.query('Variable != "PSID"').to_csv(tmp_dir / "data_types.csv", index=False)
+            self.assertFalse(load_schema(*args).is_pseudo(3, "PSID"))
+
+
+class TestPlanner(unittest.TestCase):
+
+    def test_admission_control(self):
+        print("Test that columns are only run in parallel while their estimated memory fits into the budget")
+        estimates = [estimate_column("T", f"C{i}", 'integer', rows, None, SECONDS_PER_ROW)
+                     for i, rows in enumerate([6000, 4000, 3000, 1000, 1000])]
+        budget = estimates[1].memory + estimates[3].memory
+        lock, running, peaks = threading.Lock(), [], []
+
+        def run(estimate):
+            with lock:
+                running.append(estimate.memory)
+                peaks.append(sum(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(estimate.memory)
+            return estimate.column
+
+        with ThreadPool(4) as pool:
+            done = list(run_admitted(pool, run, estimates, estimates, budget))
+        self.assertEqual(sorted(done), [f"C{i}" for i in range(5)])
+        # the first column exceeds the budget on its own and is run alone
+        self.assertEqual(peaks[0], estimates[0].memory)
+        self.assertTrue(all(peak <= budget for peak in peaks[1:]))
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    def test_manifest(self):
+        print("Test that finished columns and pools are only reused with the same parameters and unchanged files")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_dir = Path(tmp_dir)
+            spill_file = spill_column(pd.Series([1, 2, 3]), tmp_dir / "0_A.npy")
+            manifest = RunManifest(2019, 3, tmp_dir)
+            manifest.record("column", "T", "A", rows=3, files=[spill_file])
+            manifest.save_pool("PSID", generate_pseudonyms(10))
+
+            resumed = RunManifest(2019, 3, tmp_dir)
+            self.assertEqual(resumed.finished("column", "T", "A", rows=3), [spill_file])
+            self.assertIsNone(resumed.finished("column", "T", "A", rows=4))
+            self.assertIsNone(resumed.finished("column", "T", "B", rows=3))
+            self.assertEqual(list(resumed.load_pool("PSID")), list(manifest.load_pool("PSID")))
+            self.assertIsNone(RunManifest(2019, 5, tmp_dir).finished("column", "T", "A", rows=3))
+
+            spill_column(pd.Series([1, 2, 4]), spill_file)
+            self.assertIsNone(resumed.finished("column", "T", "A", rows=3))
+            resumed.clear()
+            self.assertIsNone(RunManifest(2019, 3, tmp_dir).load_pool("PSID"))
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def test_report(self):
+        print("Test that the spans are summed up per stage in the json and csv report")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_dir = Path(tmp_dir)
+            spans_file = tmp_dir / "spans.jsonl"
+            with span("clean", 2019, "T", "A", rows=3, spans_file=spans_file) as record:
+                record["distinct"] = 2
+            for column in ["A", "B"]:
+                with span("k", 2019, "T", column, rows=3, spans_file=spans_file):
+                    pass
+            report = write_report({"year": 2019}, spans_file, tmp_dir / "report.json", tmp_dir / "report.csv")
+
+            self.assertEqual(list(report["stages"]), ["clean", "k"])
+            self.assertEqual(report["stages"]["k"]["spans"], 2)
+            self.assertEqual(report["stages"]["k"]["rows"], 6)
+            self.assertEqual(report["spans"][0]["distinct"], 2)
+            self.assertTrue(all(s["wall_seconds"] >= 0 and s["cpu_seconds"] >= 0 for s in report["spans"]))
+            self.assertTrue(all(s["rows_per_second"] is None or s["rows_per_second"] > 0 for s in report["spans"]))
+            with (tmp_dir / "report.csv").open("r", newline="") as f:
+                self.assertEqual(len(list(csv.DictReader(f))), 3)
+
+    @unittest.skipIf(current_rss() is None, "the resident set size cannot be measured")
+    def test_rss_increase(self):
+        print("Test that every span reports the memory it added, not the highest memory of the process")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            spans_file = Path(tmp_dir) / "spans.jsonl"
+            with span("fetch", 2019, "T", "A", spans_file=spans_file) as large:
+                column = b"x" * 64 * 1024 ** 2
+            with span("fetch", 2019, "T", "B", spans_file=spans_file) as small:
+                pass
+            del column
+        self.assertGreater(large["rss_increase"], 32 * 1024 ** 2)
+        self.assertLess(small["rss_increase"], 8 * 1024 ** 2)
+        self.assertGreaterEqual(small["max_rss"], large["max_rss"])
+
+
+class TestVerification(unittest.TestCase):
+
+    def test_normalized_values(self):
+        print("Test that original values and the values loaded from the csv files are compared equal in SQLite")
+        cnxn = sqlite3.connect(":memory:")
+        for data_type, original, puf in [('category', [1, 2, None, 'A'], ['1.0', '2', 'nan', 'A']),
+                                         ('integer', [7, None], ['7', '']),
+                                         ('date', [20191031, 99991231, None], ['2019-10-31', '', None])]:
+            query = f"SELECT {normalized('x', data_type, 'sqlite')} FROM (SELECT ? x)"
+            self.assertEqual([cnxn.execute(query, (value,)).fetchone()[0] for value in original],
+                             [cnxn.execute(query, (value,)).fetchone()[0] for value in puf])
+        cnxn.close()
+
 
 if __name__ == '__main__':
 
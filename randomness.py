@@ -0,0 +1,116 @@
+import os
+import json
+import time
+import hashlib
+import secrets
+import argparse
+from pathlib import Path
+
+KEY_SIZE = 32
+BLOCK_SIZE = 1024 ** 2  # bytes of a stream derived at once
+
+
+def generate_run_key() -> bytes:
+    """Draw a new run key from the secure source of randomness of the operating system (/dev/urandom)."""
+    return secrets.token_bytes(KEY_SIZE)
+
+
+def load_or_generate_run_key(key_file: Path | None = None) -> bytes:
+    """
+    Returns the run key of an audit rerun, or a new run key. A new key is written into key_file, readable only by
+    its owner, so that the run can be reproduced from it. The key file must be kept secret like the original data,
+    as it reveals the order of all shuffled columns and the assignment of all pseudonyms.
+
+    Parameters:
+        key_file (Path | None): The hex encoded run key, None to use a new key without writing it
+
+    Returns:
+        run_key (bytes): The run key
+    """
+    if key_file is not None and key_file.exists():
+        run_key = bytes.fromhex(key_file.read_text().strip())
+        if len(run_key) != KEY_SIZE:
+            raise ValueError(f"The run key in {key_file} must have {KEY_SIZE} bytes.")
+        return run_key
+    run_key = generate_run_key()
+    if key_file is not None:
+        key_file.parent.mkdir(parents=True, exist_ok=True)
+        with os.fdopen(os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "w") as f:
+            f.write(run_key.hex())
+    return run_key
+
+
+class KeyedStream:
+    """
+    A stream of random bytes derived from the run key with the extendable-output function SHAKE-128, a
+    cryptographically secure generator, for one purpose of one column, e.g. (2019, 'VERS', 'GEBJAHR', 'shuffle').
+
+    Every request of bytes is a chunk of the stream, and every block of BLOCK_SIZE bytes of a chunk is derived from
+    the run key, the identifiers of the stream, the chunk and the block alone. Streams of different columns or
+    purposes are therefore independent and never overlap, they do not depend on the order the columns are processed
+    in or on the process they are processed in, and blocks can be derived in parallel. The same run key reproduces
+    every stream.
+    """
+
+    def __init__(self, run_key: bytes, *identifiers):
+        self.run_key = run_key
+        self.identifiers = identifiers
+        self.chunk = 0
+
+    def derive(self, chunk: int, block: int, size: int) -> bytes:
+        """Return the first size bytes of a block of a chunk of the stream."""
+        label = json.dumps([*self.identifiers, chunk, block]).encode()
+        return hashlib.shake_128(self.run_key + label).digest(size)
+
+    def token_bytes(self, size: int) -> bytes:
+        """Return the next chunk of the stream with size random bytes, like secrets.token_bytes."""
+        chunk, self.chunk = self.chunk, self.chunk + 1
+        return b"".join(self.derive(chunk, block, min(BLOCK_SIZE, size - start))
+                        for block, start in enumerate(range(0, size, BLOCK_SIZE)))
+
+
+def get_stream(run_key: bytes | None, *identifiers) -> KeyedStream | None:
+    """Returns the stream of the identifiers, or None to draw from the secure source of randomness of the
+    operating system if no run key is given."""
+    return None if run_key is None else KeyedStream(run_key, *identifiers)
+
+
+def benchmark(size: int, repeat: int = 3) -> dict:
+    """
+    Measures the throughput of the keyed streams and of the secure source of randomness of the operating system,
+    for the random bytes alone and for shuffling a column of 8-byte values.
+
+    Parameters:
+        size (int): The number of random bytes per measurement
+        repeat (int): The number of measurements, the fastest one is reported
+
+    Returns:
+        throughput (dict): The throughput in MB/s of every measurement
+    """
+    from functions import secure_permutation
+
+    def measure(function) -> float:
+        seconds = []
+        for _ in range(repeat):
+            begin = time.perf_counter()
+            function()
+            seconds.append(time.perf_counter() - begin)
+        return size / min(seconds) / 1e6
+
+    run_key = generate_run_key()
+    n_rows = size // 8
+    return {"bytes, secrets": measure(lambda: secrets.token_bytes(size)),
+            "bytes, keyed stream": measure(lambda: KeyedStream(run_key, "benchmark").token_bytes(size)),
+            "bytes, secrets per row": measure(lambda: [secrets.token_bytes(8) for _ in range(n_rows)]),
+            "shuffle, secrets": measure(lambda: secure_permutation(n_rows)),
+            "shuffle, keyed stream": measure(lambda: secure_permutation(n_rows,
+                                                                        KeyedStream(run_key, "benchmark")))}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark of the sources of randomness")
+    parser.add_argument("--size", default=64, type=int, help="Random bytes per measurement in MB, default: 64")
+    args = parser.parse_args()
+
+    for measurement, throughput in benchmark(args.size * 1024 ** 2).items():
+        print(f"{measurement:<24}{throughput:>10.0f} MB/s")
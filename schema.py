@@ -0,0 +1,126 @@
+import csv
+import os
+import pickle
+from pathlib import Path
+
+DATA_TYPES_FILE = Path("data_types.csv")
+VARIABLE_PROCESSING_FILE = Path("variable_processing.csv")
+COMPILED_SCHEMA_FILE = Path("__pycache__/schema.pickle")
+DATA_MODELS = {"DM1+2": 2, "DM3": 3}
+# increase whenever SchemaRegistry changes, so that outdated precompiled files are compiled again
+SCHEMA_VERSION = 1
+
+_REGISTRY = None
+
+
+class SchemaRegistry:
+    """
+    Variables, data types and processing methods of all tables, parsed once from data_types.csv and
+    variable_processing.csv. All lookups by data model, table and variable are dictionary lookups.
+    """
+
+    def __init__(self, data_types: list, variable_processing: list):
+        self.data_types = {}
+        self.tables = {}
+        self.pseudo_variables = {}
+        self.pseudo_mapping = {}
+        for row in data_types:
+            data_model = int(row["Datamodel"])
+            self.data_types.setdefault(data_model, {})[row["Variable"]] = row["Type"]
+            self.tables.setdefault(data_model, {}).setdefault(row["Table"], []).append(row["Variable"])
+            if row["Type"] == "pseudo":
+                self.pseudo_variables.setdefault(data_model, []).append(row["Variable"])
+                self.pseudo_mapping.setdefault(data_model, {})[row["Variable"]] = row["Table"]
+        self.methods = {}
+        for row in variable_processing:
+            data_model = DATA_MODELS[row["Datenmodell"]]
+            self.methods.setdefault(data_model, {})[row["Datenfeldname"]] = (row["PUF Methode"], row["Pool"] or None)
+
+    def get_data_types(self, data_model: int) -> dict:
+        return self.data_types.get(data_model, {})
+
+    def get_data_type(self, data_model: int, variable: str) -> str | None:
+        return self.data_types.get(data_model, {}).get(variable)
+
+    def get_variables(self, data_model: int, table: str) -> list:
+        return self.tables.get(data_model, {}).get(table, [])
+
+    def get_pseudo_variables(self, data_model: int) -> list:
+        return self.pseudo_variables.get(data_model, [])
+
+    def get_pseudo_mapping(self, data_model: int) -> dict:
+        return self.pseudo_mapping.get(data_model, {})
+
+    def is_pseudo(self, data_model: int, variable: str) -> bool:
+        return variable in self.pseudo_mapping.get(data_model, {})
+
+    def get_method(self, data_model: int, variable: str) -> tuple:
+        """Return the PUF method of a variable and the pool it is drawn from, as listed in variable_processing.csv."""
+        return self.methods.get(data_model, {}).get(variable, (None, None))
+
+
+def _source_stamp(source_files: tuple) -> tuple:
+    return (SCHEMA_VERSION,) + tuple((str(path), os.stat(path).st_mtime_ns, os.stat(path).st_size)
+                                     for path in source_files)
+
+
+def compile_schema(data_types_file: Path = DATA_TYPES_FILE,
+                   variable_processing_file: Path = VARIABLE_PROCESSING_FILE) -> SchemaRegistry:
+    """
+    Parses the schema files into a registry.
+
+    Parameters:
+        data_types_file (Path): The csv file with table, variable, type and data model of every variable
+        variable_processing_file (Path): The csv file with the PUF method of every variable
+
+    Returns:
+        registry (SchemaRegistry): The parsed schema
+    """
+    with open(data_types_file, newline="", encoding="utf-8") as f:
+        data_types = list(csv.DictReader(f))
+    with open(variable_processing_file, newline="", encoding="utf-8") as f:
+        variable_processing = list(csv.DictReader(f))
+    return SchemaRegistry(data_types, variable_processing)
+
+
+def load_schema(compiled_file: Path = COMPILED_SCHEMA_FILE,
+                data_types_file: Path = DATA_TYPES_FILE,
+                variable_processing_file: Path = VARIABLE_PROCESSING_FILE) -> SchemaRegistry:
+    """
+    Loads the precompiled registry, if it was compiled from the current schema files, and compiles it otherwise.
+
+    Parameters:
+        compiled_file (Path): The pickle file the compiled registry is cached in
+        data_types_file (Path): The csv file with table, variable, type and data model of every variable
+        variable_processing_file (Path): The csv file with the PUF method of every variable
+
+    Returns:
+        registry (SchemaRegistry): The parsed schema
+    """
+    stamp = _source_stamp((data_types_file, variable_processing_file))
+    try:
+        with open(compiled_file, "rb") as f:
+            cached_stamp, registry = pickle.load(f)
+        if cached_stamp == stamp:
+            return registry
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ValueError):
+        pass
+    registry = compile_schema(data_types_file, variable_processing_file)
+    try:
+        compiled_file.parent.mkdir(exist_ok=True)
+        with open(compiled_file, "wb") as f:
+            pickle.dump((stamp, registry), f, protocol=pickle.HIGHEST_PROTOCOL)
+    except OSError:
+        pass  # the cache is optional, e.g. in a read-only checkout
+    return registry
+
+
+def get_schema() -> SchemaRegistry:
+    """
+    Returns the schema registry of the current process, which is loaded on first use.
+    Forked worker processes inherit the registry of their parent, spawned ones load the precompiled file.
+    """
+    global _REGISTRY
+    if _REGISTRY is None:
+        _REGISTRY = load_schema()
+    return _REGISTRY
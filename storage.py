@@ -0,0 +1,231 @@
+import sys
+import csv
+import gzip
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # only needed to export parquet and arrow files
+    pa = pq = None
+try:
+    import zstandard
+except ImportError:  # only needed to export zstd compressed csv files
+    zstandard = None
+
+CHUNK_SIZE = 100_000
+EXPORT_FORMATS = {"parquet": ".parquet", "arrow": ".arrow", "csv.gz": ".csv.gz", "csv.zst": ".csv.zst"}
+# the text of missing values in the spilled columns, see to_csv_text
+MISSING_VALUES = ['', 'nan', 'None', 'NaT']
+
+
+def to_csv_text(values: pd.Series, data_type: str = None) -> np.ndarray:
+    """Convert a column into the text written to the csv files, as csv.writer would format it.
+
+    Dates are written as YYYY-MM-DD, and missing dates and integers as empty fields. Categorical columns are converted
+    once per category, their missing values are written as 'nan', or as empty fields for codes of type string.
+
+    Parameters:
+        values (pandas.Series): Processed column of any type
+        data_type (str): The type of data as defined in `data_types.csv`, if known
+
+    Returns:
+        numpy.ndarray: Fixed-width array of utf-8 encoded values
+    """
+    values = pd.Series(values)
+    if len(values) == 0:
+        return np.array([], dtype='S1')
+    if pd.api.types.is_datetime64_dtype(values.dtype):
+        text = np.datetime_as_string(values.to_numpy(), unit='D').astype('S')
+        text[values.isna().to_numpy()] = b''
+        return text
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        categories = values.cat.categories.astype(str).to_numpy(dtype=object).astype(str)
+        missing = '' if data_type == 'string' else 'nan'
+        # the last entry of the lookup is used for missing values, which have the code -1
+        lookup = np.char.encode(np.append(categories, missing), 'utf-8')
+        return lookup[values.cat.codes.to_numpy()]
+    text = values.astype(str).to_numpy(dtype=object)
+    if values.dtype == object:
+        # csv.writer writes None as an empty field
+        text[np.equal(values.to_numpy(), None)] = ''
+    elif isinstance(values.dtype, pd.Int64Dtype):
+        # missing integers are written as empty fields like missing dates, Oracle loads them as NULL
+        text[values.isna().to_numpy()] = ''
+    return np.char.encode(text.astype(str), 'utf-8')
+
+
+def spill_column(values: pd.Series, spill_file: Path, data_type: str = None) -> Path:
+    """Write a processed column once into its own binary file, which can be memory-mapped later.
+
+    Parameters:
+        values (pandas.Series): Processed column
+        spill_file (Path): Target .npy file
+        data_type (str): The type of data as defined in `data_types.csv`, if known
+
+    Returns:
+        spill_file (Path): The written file
+    """
+    np.save(spill_file, to_csv_text(values, data_type))
+    return spill_file
+
+
+def iter_spilled_column(spill_files: list, chunk_size: int = CHUNK_SIZE):
+    """Yield the rows of a column spilled into one or more files in chunks of chunk_size rows.
+
+    Parameters:
+        spill_files (list): The .npy files of the column, in order
+        chunk_size (int): Number of rows per chunk
+
+    Returns:
+        generator: Memory-mapped or concatenated arrays of chunk_size rows, the last one may be shorter
+    """
+    pending = []
+    n_pending = 0
+    for spill_file in spill_files:
+        array = np.load(spill_file, mmap_mode='r')
+        start = 0
+        while start < len(array):
+            piece = array[start:start + chunk_size - n_pending]
+            start += len(piece)
+            if not pending and len(piece) == chunk_size:
+                yield piece
+                continue
+            pending.append(piece)
+            n_pending += len(piece)
+            if n_pending == chunk_size:
+                yield np.concatenate(pending)
+                pending, n_pending = [], 0
+    if pending:
+        yield np.concatenate(pending)
+
+
+def open_csv(csv_file: Path, compression: str = None):
+    """Open a csv file for writing, uncompressed or compressed with 'gzip' or 'zstd'."""
+    if compression is None:
+        return csv_file.open("w", newline="")
+    if compression == "gzip":
+        return gzip.open(csv_file, "wt", newline="")
+    if compression == "zstd":
+        if zstandard is None:
+            sys.exit("The package zstandard is needed to export zstd compressed csv files.")
+        return zstandard.open(csv_file, "w", newline="")
+    sys.exit(f"Compression {compression} not supported. Choose from gzip or zstd")
+
+
+def merge_spilled_columns(spill_files: list, columns: list, csv_final: Path, chunk_size: int = CHUNK_SIZE,
+                          compression: str = None):
+    """Merge spilled columns into one csv file in a single streaming pass.
+
+    Only one chunk of rows per column is decoded at a time, the spill files are memory-mapped.
+
+    Parameters:
+        spill_files (list): The .npy file, or the list of .npy files, of every column in the order of the columns
+        columns (list): The column names written as header
+        csv_final (Path): The merged csv file
+        chunk_size (int): Number of rows written at once
+        compression (str): None for a plain csv file, 'gzip' or 'zstd'
+
+    Returns:
+        n_rows (int): The number of rows written
+    """
+    n_rows = 0
+    column_chunks = [iter_spilled_column(files if isinstance(files, list) else [files], chunk_size)
+                     for files in spill_files]
+    with open_csv(csv_final, compression) as f:
+        writer = csv.writer(f, delimiter=",")
+        writer.writerow(columns)
+        for chunk in zip(*column_chunks):
+            writer.writerows(zip(*[np.char.decode(array, 'utf-8') for array in chunk]))
+            n_rows += len(chunk[0])
+    return n_rows
+
+
+def check_export_formats(formats: list):
+    """Exit if a format is not supported or the package needed to export it is not installed."""
+    for export_format in formats:
+        if export_format not in EXPORT_FORMATS:
+            sys.exit(f"Export format {export_format} not supported. Choose from {', '.join(EXPORT_FORMATS)}")
+        if export_format in ("parquet", "arrow") and pa is None:
+            sys.exit(f"The package pyarrow is needed to export {export_format} files.")
+        if export_format == "csv.zst" and zstandard is None:
+            sys.exit("The package zstandard is needed to export zstd compressed csv files.")
+
+
+def arrow_type(data_type: str):
+    """Return the arrow type of a column with the type of data as defined in `data_types.csv`."""
+    if data_type in ('integer', 'year', 'month'):
+        return pa.int64()
+    if data_type == 'float':
+        return pa.float64()
+    if data_type == 'date':
+        return pa.date32()
+    # codes, pseudonyms and columns of unknown type are kept as text
+    return pa.string()
+
+
+def to_arrow(text: np.ndarray, data_type: str):
+    """Convert a chunk of a spilled column into a typed arrow array, with its missing values as nulls.
+
+    Parameters:
+        text (numpy.ndarray): Fixed-width array of utf-8 encoded values, as written by spill_column
+        data_type (str): The type of data as defined in `data_types.csv`
+
+    Returns:
+        pyarrow.Array: The values of the chunk
+    """
+    values = np.char.decode(text, 'utf-8')
+    missing = np.isin(values, MISSING_VALUES)
+    if data_type == 'date':
+        values = np.where(missing, 'NaT', values).astype('datetime64[D]')
+        return pa.array(values, type=pa.date32(), from_pandas=True)
+    if data_type in ('integer', 'year', 'month', 'float'):
+        numbers = pd.to_numeric(pd.Series(np.where(missing, '', values)), errors='coerce')
+        invalid = numbers.isna().to_numpy() & ~missing
+        if invalid.any():
+            raise ValueError(f"{values[invalid][0]} is not a value of type {data_type}")
+        return pa.array(numbers, type=arrow_type(data_type), from_pandas=True)
+    return pa.array(values, type=pa.string(), mask=missing)
+
+
+def export_spilled_columns(spill_files: list, columns: list, data_types: list, export_file: Path,
+                           export_format: str, chunk_size: int = CHUNK_SIZE) -> int:
+    """Export spilled columns into one compressed file in a single streaming pass.
+
+    Parquet files are written with one row group of chunk_size rows per chunk, compressed with zstd and with the
+    statistics of every column. Arrow IPC files are written with one zstd compressed record batch per chunk.
+    The columns are typed as defined in `data_types.csv`. The csv formats are written as by merge_spilled_columns.
+
+    Parameters:
+        spill_files (list): The .npy file, or the list of .npy files, of every column in the order of the columns
+        columns (list): The column names
+        data_types (list): The type of data of every column as defined in `data_types.csv`
+        export_file (Path): The exported file
+        export_format (str): One of EXPORT_FORMATS
+        chunk_size (int): Number of rows written at once
+
+    Returns:
+        n_rows (int): The number of rows written
+    """
+    check_export_formats([export_format])
+    if export_format in ("csv.gz", "csv.zst"):
+        compression = "gzip" if export_format == "csv.gz" else "zstd"
+        return merge_spilled_columns(spill_files, columns, export_file, chunk_size, compression)
+
+    n_rows = 0
+    schema = pa.schema([(col, arrow_type(data_type)) for col, data_type in zip(columns, data_types)])
+    column_chunks = [iter_spilled_column(files if isinstance(files, list) else [files], chunk_size)
+                     for files in spill_files]
+    if export_format == "parquet":
+        writer = pq.ParquetWriter(export_file, schema, compression="zstd", write_statistics=True)
+    else:
+        writer = pa.ipc.new_file(export_file, schema, options=pa.ipc.IpcWriteOptions(compression="zstd"))
+    with writer:
+        for chunk in zip(*column_chunks):
+            arrays = [to_arrow(array, data_type) for array, data_type in zip(chunk, data_types)]
+            writer.write_batch(pa.record_batch(arrays, schema=schema))
+            n_rows += len(chunk[0])
+    return n_rows
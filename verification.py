@@ -0,0 +1,248 @@
+import os
+import sys
+import csv
+import argparse
+from pathlib import Path
+from typing import NamedTuple
+from multiprocessing import Pool, cpu_count
+
+from helpers import (SQLITE_FILE_VARIABLE, get_session, close_sessions, get_data_type, get_constant_variables,
+                     get_secondary_pools_dm3)
+from schema import get_schema
+from generate_puf import K, get_prefix, get_source_table, get_tables, get_output_dir, get_data_model_from_year
+
+
+class CheckResult(NamedTuple):
+    year: int
+    table: str
+    column: str | None
+    check: str
+    value: float | int | None
+    expected: str
+    passed: bool
+
+
+def normalized(column: str, data_type: str, dsn: str) -> str:
+    """
+    Returns the SQL expression of a column which is comparable between the original and the _puf table.
+    The _puf tables are loaded from the csv files, so in SQLite numbers may be stored as text like '1.0',
+    missing values as 'nan' or '' and dates as YYYY-MM-DD instead of YYYYMMDD. In Oracle the columns are typed.
+    Dates which clean_data cannot represent, e.g. 99991231, are missing values in both tables.
+
+    Parameters:
+        column (str): The name of the column
+        data_type (str): The type of data as defined in `data_types.csv`
+        dsn (str): The data source name, sqlite or oracle
+
+    Returns:
+        expression (str): The SQL expression
+    """
+    if dsn == "sqlite":
+        text = f"CAST({column} AS TEXT)"
+    elif dsn == "oracle":
+        text = f"CAST({column} AS VARCHAR2(32))"
+    else:
+        sys.exit("SQL dialect not supported. Choose from sqlite or oracle")
+    if data_type == 'date':
+        text = f"REPLACE({text}, '-', '')"
+        return f"CASE WHEN LENGTH({text}) = 8 AND {text} BETWEEN '16770922' AND '22620411' THEN {text} END"
+    if dsn == "oracle":
+        return column
+    return (f"CASE WHEN {text} IN ('', 'nan', 'None', 'NaT') THEN NULL "
+            f"WHEN {text} GLOB '*[^0-9.+-]*' THEN {text} ELSE CAST({text} AS REAL) END")
+
+
+def get_pool_source(column: str, table: str, data_model: int) -> tuple[str, str]:
+    """
+    Returns the table and column whose distinct values determine the size of the id pool of a pseudonymized column.
+
+    Parameters:
+        column (str): The name of the pseudonymized column
+        table (str): The name of the table (Satzart) of the column
+        data_model (int): The data model
+
+    Returns:
+        source_table (str): The name of the table (Satzart) the pool is generated from
+        source_column (str): The name of the column the pool is generated from
+    """
+    if data_model == 2:
+        key = column[column.find("_") + 1:]
+        return "SA151", f"SA151_{key}"
+    key = get_secondary_pools_dm3().get(column, column)
+    return get_schema().get_pseudo_mapping(data_model)[key], key
+
+
+def verify_table(arguments) -> list:
+    """
+    Checks that the _puf table has the columns and the number of rows of the original table.
+
+    Parameters:
+        arguments (tuple): Contains the table name (str) and the command line arguments (argparse.Namespace)
+
+    Returns:
+        results (list): The result of every check
+    """
+    table, args = arguments
+    data_model: int = get_data_model_from_year(args.year)
+    session = get_session(args.dsn, args.username, args.password, data_model)
+    table_name = get_source_table(table, args)
+    puf_table = f"{get_prefix(table, data_model)}{args.year}{table}_puf"
+    columns, puf_columns = session.get_columns(table_name), session.get_columns(puf_table)
+    rows, puf_rows = session.count_rows(table_name), session.count_rows(puf_table)
+    return [CheckResult(args.year, table, None, "columns", len(set(columns) ^ set(puf_columns)), "0",
+                        set(columns) == set(puf_columns)),
+            CheckResult(args.year, table, None, "rows", puf_rows, str(rows), puf_rows == rows)]
+
+
+def verify_column(arguments) -> list:
+    """
+    Checks a column of a _puf table in the database, without fetching its rows.
+
+    Pseudonymized columns may have at most as many distinct values as their id pool. Every other column must
+    fulfill k-anonymity, i.e. no value may occur less than k times, and its histogram may only differ from the
+    histogram of the original column in the rows which k-anonymity requires to change: the rows of values
+    occurring less than k times, and for categories the smallest category merged into 'Other' with them.
+
+    Parameters:
+        arguments (tuple): Contains the table name (str), the column name (str) and the command line arguments
+        (argparse.Namespace)
+
+    Returns:
+        results (list): The result of every check
+    """
+    table, col, args = arguments
+    data_model: int = get_data_model_from_year(args.year)
+    session = get_session(args.dsn, args.username, args.password, data_model)
+    table_name = get_source_table(table, args)
+    puf_table = f"{get_prefix(table, data_model)}{args.year}{table}_puf"
+
+    if get_schema().is_pseudo(data_model, col):
+        source_table, source_column = get_pool_source(col, table, data_model)
+        pool_size = session.count_distinct(get_source_table(source_table, args), source_column)
+        distinct = session.count_distinct(puf_table, col)
+        return [CheckResult(args.year, table, col, "pool", distinct, f"<= {pool_size}", distinct <= pool_size)]
+
+    data_type = get_data_type(col, data_model=data_model)
+    with session.connect() as (cnxn, cursor):
+        # values occurring less than k times, missing values included
+        cursor.execute(f"SELECT COUNT(*) FROM (SELECT {col} FROM {puf_table} GROUP BY {col} "
+                       f"HAVING COUNT(*) < {args.k}) t")
+        violations = cursor.fetchall()[0][0]
+
+        # rows whose value differs between the histograms, i.e. half the sum of the absolute differences
+        value = normalized(col, data_type, args.dsn)
+        cursor.execute(f"SELECT SUM(ABS(n_original - n_puf)), "
+                       f"SUM(CASE WHEN n_original < {args.k} THEN n_original ELSE 0 END), "
+                       f"MIN(CASE WHEN n_original >= {args.k} THEN n_original END) FROM "
+                       f"(SELECT v, SUM(n_original) n_original, SUM(n_puf) n_puf FROM "
+                       f"(SELECT {value} v, COUNT(*) n_original, 0 n_puf FROM {table_name} GROUP BY {value} "
+                       f"UNION ALL SELECT {value} v, 0 n_original, COUNT(*) n_puf FROM {puf_table} GROUP BY {value}) t "
+                       f"GROUP BY v) h")
+        difference, rare_rows, smallest = cursor.fetchall()[0]
+    changed_rows = (difference or 0) / 2
+    allowed_rows = (rare_rows or 0) + (smallest or 0 if rare_rows and data_type in ('category', 'alphanumeric') else 0)
+    return [CheckResult(args.year, table, col, "k", violations, "0", violations == 0),
+            CheckResult(args.year, table, col, "histogram", changed_rows, f"<= {allowed_rows}",
+                        changed_rows <= allowed_rows)]
+
+
+def plan_checks(args: argparse.Namespace) -> tuple[list, list]:
+    """
+    Returns the table checks and the column checks of a year, the column checks of the largest tables first.
+
+    Parameters:
+        args (argparse.Namespace): Dictionary containing command line arguments, with the year to verify
+
+    Returns:
+        table_checks (list): The arguments of verify_table for every table
+        column_checks (list): The arguments of verify_column for every column
+    """
+    data_model: int = get_data_model_from_year(args.year)
+    session = get_session(args.dsn, args.username, args.password, data_model)
+    constant_variables = set(get_constant_variables(data_model=data_model))
+    tables = get_tables(data_model)[0]
+    table_checks = [(table, args) for table in tables]
+    column_checks, rows = [], []
+    for table in tables:
+        table_name = get_source_table(table, args)
+        n = session.count_rows(table_name)
+        for col in session.get_columns(table_name):
+            if col not in constant_variables:
+                column_checks.append((table, col, args))
+                rows.append(n)
+    order = sorted(range(len(column_checks)), key=lambda i: rows[i], reverse=True)
+    return table_checks, [column_checks[i] for i in order]
+
+
+def verify(args: argparse.Namespace, num_processes: int = 1) -> list:
+    """
+    Verifies all _puf tables of the years in the database, with the columns distributed to several processes.
+
+    Parameters:
+        args (argparse.Namespace): Dictionary containing command line arguments
+        num_processes (int): The number of processes
+
+    Returns:
+        results (list): The result of every check
+    """
+    table_checks, column_checks = [], []
+    for year in args.years or [args.year]:
+        year_args = argparse.Namespace(**{**vars(args), "year": year})
+        year_table_checks, year_column_checks = plan_checks(year_args)
+        table_checks += year_table_checks
+        column_checks += year_column_checks
+    results = []
+    if num_processes > 1:
+        with Pool(num_processes) as pool:
+            for table_results in pool.imap_unordered(verify_table, table_checks):
+                results += table_results
+            for column_results in pool.imap_unordered(verify_column, column_checks):
+                results += column_results
+    else:
+        for arguments in table_checks:
+            results += verify_table(arguments)
+        for arguments in column_checks:
+            results += verify_column(arguments)
+    return sorted(results, key=lambda r: (r.year, r.table, r.column or "", r.check))
+
+
+def write_results(results: list, report_file: Path):
+    """Writes the result of every check into a csv file."""
+    report_file.parent.mkdir(parents=True, exist_ok=True)
+    with report_file.open("w", newline="") as f:
+        writer = csv.writer(f, delimiter=",")
+        writer.writerow(CheckResult._fields)
+        writer.writerows(results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Script to verify the public use file in the database")
+    parser.add_argument("--dsn", default="sqlite", help="Data source name for ODBC data source, default: sqlite")
+    parser.add_argument("--username", default="fdz", help="Username to connect to database, default: fdz")
+    parser.add_argument("--password", default="fdz", help="Password to connect to database, default: fdz")
+    parser.add_argument("--sqlite_file", default=None,
+                        help="SQLite database file, e.g. generated by generate_test_data.py, default: "
+                             "dm3_testdaten.sqlite for DM3, test_data/fdz_generated_data_dm12.db for DM1/2")
+    default_year: int = 2016
+    parser.add_argument("--year", default=default_year, type=int, help=f"Year to verify, default: {default_year}")
+    parser.add_argument("--years", default=None, type=int, nargs='+',
+                        help="Several years to verify in one run, replaces --year, default: None")
+    parser.add_argument("--k", default=K, type=int, help=f"Parameter of k-anonymity, default: {K}")
+    parser.add_argument("--sample_fraction", default=None, type=float,
+                        help="Compare with the persons sampled by a run with --sample_fraction, default: all persons")
+    parser.add_argument("--multi_threading", action='store_true', help="Whether to verify the columns in multiple "
+                                                                       "processes, default: False")
+    args = parser.parse_args()
+    if args.sqlite_file is not None:
+        os.environ[SQLITE_FILE_VARIABLE] = args.sqlite_file
+
+    results = verify(args, cpu_count() if args.multi_threading else 1)
+    close_sessions()
+    for year in args.years or [args.year]:
+        write_results([r for r in results if r.year == year], get_output_dir(year) / "verification.csv")
+    failed = [r for r in results if not r.passed]
+    for r in failed:
+        print(f"{r.year} {r.table}{'.' + r.column if r.column else ''}: {r.check} check failed with {r.value}, "
+              f"expected {r.expected}")
+    print(f"{len(results) - len(failed)} of {len(results)} checks passed.")
+    sys.exit(1 if failed else 0)